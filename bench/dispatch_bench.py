@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Microbenchmark for DiffRunner handler dispatch
+#
+# Compares the previous dispatch loop, which rebuilt the handler list for
+# every change, against the dispatch table and the grouped dispatch loop,
+# with and without a retry journal as configured by Squeeze.
+# Run from the repository root with `python bench/dispatch_bench.py`.
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from squeeze import *
+from squeeze.core import DiffRunner
+from squeeze.journal import RetryJournal
+
+CHANGES = 200000
+HANDLERS = 12
+REPEAT = 5
+
+class FakeRepo(object):
+   """Repo that returns the same changes for every diff"""
+   supports_raw = False
+
+   def __init__(self, changes):
+      self.changes = changes
+
+   def has_commit(self, identifier):
+      return True
+
+   def diff(self, a, b):
+      return self.changes
+
+def make_changes(count):
+   deltas = [FILE_ADDED, FILE_MODIFIED, FILE_MODIFIED, FILE_DELETED, FILE_RENAMED]
+   changes = []
+   for i in range(count):
+      delta = deltas[i % len(deltas)]
+      if delta == FILE_RENAMED:
+         changes.append((delta, ["dir/file{0}".format(i), "dir2/file{0}".format(i)]))
+      else:
+         changes.append((delta, ["dir/file{0}".format(i)]))
+
+   return changes
+
+def handler(delta, *files):
+   pass
+
+def make_runner(changes, journal=None):
+   runner = DiffRunner(FakeRepo(changes), journal)
+   masks = [FILE_ADDED, FILE_MODIFIED, FILE_DELETED, FILE_RENAMED | FILE_COPIED,
+            FILE_ADDED | FILE_MODIFIED, FILE_ANY]
+   for i in range(HANDLERS):
+      runner.add_handler(handler, masks[i % len(masks)])
+
+   return runner
+
+def previous_run(runner, changes):
+   """The dispatch loop as it was before the dispatch table"""
+   def get_handlers_for(delta):
+      funcs = []
+      for index in [x for x in runner.handlers if x & delta]:
+         funcs = funcs + runner.handlers[index]
+
+      return funcs
+
+   for changetype, files in changes:
+      for function in get_handlers_for(changetype):
+         function(changetype, *files)
+
+def main():
+   changes = make_changes(CHANGES)
+   runner = make_runner(changes)
+
+   # The journal is never saved, it only needs somewhere it could be written
+   tmpdir = tempfile.mkdtemp()
+   journaled = make_runner(changes, RetryJournal(os.path.join(tmpdir, "retry.json")))
+
+   cases = [
+      ("previous loop", lambda: previous_run(runner, changes)),
+      ("dispatch table", lambda: runner.run("a", "b")),
+      ("grouped", lambda: runner.run("a", "b", grouped=True)),
+      ("journaled", lambda: journaled.run("a", "b")),
+      ("grouped journaled", lambda: journaled.run("a", "b", grouped=True))
+   ]
+
+   print("{0} changes, {1} handlers, best of {2}".format(CHANGES, HANDLERS, REPEAT))
+   baseline = None
+   for name, func in cases:
+      best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+      if baseline is None:
+         baseline = best
+      print("{0:<18} {1:8.3f}s {2:6.2f}x".format(name, best, baseline / best))
+
+   shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+   main()
@@ -16,7 +16,10 @@ setup(
    author='Ryan Kadwell',
    author_email='ryan@riaka.ca',
    packages=['squeeze'],
-   scripts=["bin/squeeze"],
+   python_requires='>=3.7',
+   entry_points={
+      "console_scripts": ["squeeze = squeeze.cli:main"]
+   },
    # url='http://pypi.python.org/pypi/Squeeze/',
    license='LICENSE.txt',
    description='Library for parsing change sets from version control systems',
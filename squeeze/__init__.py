@@ -14,7 +14,8 @@ from .core import (
    FILE_DELETED,
    FILE_MODIFIED,
    FILE_COPIED,
-   FILE_RENAMED
+   FILE_RENAMED,
+   FILE_ANY
    )
 
 __all__ = [
@@ -23,5 +24,6 @@ __all__ = [
    "FILE_DELETED",
    "FILE_MODIFIED",
    "FILE_COPIED",
-   "FILE_RENAMED"
+   "FILE_RENAMED",
+   "FILE_ANY"
    ]
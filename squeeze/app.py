@@ -17,11 +17,19 @@ import yaml
 from .repo import get_repo
 from .util import Command
 from .core import DiffRunner
+from .journal import RetryJournal
+from .cache import BlobCache
+from .history import HistoryLog
 
 class Squeeze(object):
    """Implementation of the squeeze library"""
-   def __init__(self):
-      """Initialize the Application Runner"""
+   def __init__(self, journal=True):
+      """Initialize the Application Runner
+
+         With journal set to False exceptions raised by handlers stop the run,
+         without moving the last run commit, instead of being written to the
+         retry journal.
+      """
       self.project_base_dir = self.get_base_dir()
 
       if self.project_base_dir == None:
@@ -32,18 +40,17 @@ class Squeeze(object):
 
       self.data_path = os.path.abspath(self.project_base_dir + "/.squeeze")
 
-      self.logger.debug('Initializing')
-      # Check & initialize lockfile
+      # The lockfile is only created by run() once we know there is work to
+      # do so idle runs stay cheap.
       self.lockfile = os.path.abspath(self.data_path + '/.lock')
-      if not create_pid_lock_file(self.lockfile):
-         self.logger.critical("Unable to create lockfile for process")
-         self.exit("Unable to create lockfile for process")
+      self.locked = False
 
       # Initialize the handlers container
       self.handlers = {}
 
       # These files do not neccesarily exist at this point.
       self.latest_run = os.path.abspath(self.data_path + "/latest")
+      self.ref_state_file = os.path.abspath(self.data_path + "/refstate")
 
       # Load the config file. Creating it if it does not already exist.
       config_path = self.data_path + "/config.yml"
@@ -52,42 +59,31 @@ class Squeeze(object):
 
       self.config = Config(config_path)
 
-      self.repo = repo = get_repo(
-         repo_type=self.config.get("repo", "git"),
-         path=self.project_base_dir,
-         rename_similarity=self.config.get("similarity.rename", 100),
-         copy_similarity=self.config.get("similarity.copy", 100)
+      self.repo = open_repo(self.project_base_dir, self.config)
+
+      # Changes whose handlers fail are journaled and retried on later runs
+      self.journal = None
+      if journal:
+         self.journal = RetryJournal(
+            os.path.abspath(self.data_path + "/retry.json"),
+            max_attempts=self.config.get("retry.max_attempts", 5),
+            backoff=self.config.get("retry.backoff", 60)
+            )
+
+      # Blobs already processed by handlers added with cache=True
+      self.cache = BlobCache(
+         os.path.abspath(self.data_path + "/blobcache"),
+         max_entries=self.config.get("cache.max_entries", 100000)
          )
 
+      # Log of every change processed, indexed by path
+      self.history = open_history(self.data_path, self.config)
+
       # Setup the runner
-      self.runner = DiffRunner(self.repo)
+      self.runner = DiffRunner(self.repo, self.journal, self.cache, self.history)
 
    def get_base_dir(self):
-      startpath = os.getcwd()
-      if self._is_base_dir(startpath):
-         return startpath
-
-      prev_checkpath = startpath
-      checkpath = self._parent_path(startpath)
-
-      while checkpath != prev_checkpath:
-         if self._is_base_dir(checkpath):
-            return checkpath
-
-         prev_checkpath = checkpath
-         checkpath = self._parent_path(checkpath)
-
-      return None
-
-   def _parent_path(self, path):
-      return os.path.abspath(path + "/..").replace('//','/')
-
-   def _is_base_dir(self, path):
-      for filename in os.listdir(path):
-         if filename == ".squeeze" and os.path.isdir(os.path.abspath(path + "/.squeeze")):
-            return True
-
-      return False
+      return find_base_dir(os.getcwd())
 
    @property
    def logger(self):
@@ -109,12 +105,9 @@ class Squeeze(object):
       try:
          return self._last_run_hash
       except AttributeError:
-         if not os.path.exists(self.latest_run):
+         self._last_run_hash = read_last_run(self.data_path)
+         if self._last_run_hash is None:
             self.logger.warn('Unable to determin last run. Treating all files as new!')
-            self._last_run_hash = None
-         else:
-            with open(self.latest_run, "r") as f:
-               self._last_run_hash = f.read().strip()
 
          return self._last_run_hash
 
@@ -127,6 +120,19 @@ class Squeeze(object):
          f.write(value)
 
    def run(self):
+      # Compare the current refs to those seen by the last run before doing
+      # anything else. When nothing has changed there is no need to start a
+      # logger, take the lock or run any VCS commands.
+      ref_state = self.repo.ref_state()
+      if self._is_up_to_date(ref_state):
+         return
+
+      if not create_pid_lock_file(self.lockfile):
+         self.logger.critical("Unable to create lockfile for process")
+         self.exit("Unable to create lockfile for process")
+
+      self.locked = True
+
       self.logger.debug('Starting Run')
       try:
          commits = self.repo.commit_list
@@ -146,9 +152,21 @@ class Squeeze(object):
 
          self.logger.notice("Querying changes from {0} to {1}.".format(self.last_run, latest_hash))
 
-         self.runner.run(self.last_run, latest_hash)
+         self.runner.retry()
+         self.runner.run(
+            self.last_run, latest_hash,
+            grouped=self.config.get("dispatch.grouped", False)
+            )
+
+         self.cache.save()
+         if self.journal is not None:
+            self.journal.save()
+            if self.journal.pending or self.journal.dead:
+               self.logger.error("{0} change(s) waiting for retry and {1} dead in {2}".format(
+                  len(self.journal.pending), len(self.journal.dead), self.journal.filename))
 
          self.last_run = latest_hash
+         self._save_ref_state(ref_state, latest_hash)
 
          # Done processing so cleanup
          self._cleanup()
@@ -156,7 +174,41 @@ class Squeeze(object):
       except Exception as e:
          self.exit(str(e))
 
+   def _is_up_to_date(self, ref_state):
+      """Return True if the refs and cursor match the last run and no retries
+         are due
+
+         The cursor is compared too so moving it back by hand to process a
+         range again is not mistaken for an idle run.
+      """
+      if ref_state is None or not os.path.exists(self.ref_state_file):
+         return False
+
+      cursor = read_last_run(self.data_path)
+      if cursor is None:
+         return False
+
+      if self.journal is not None and self.journal.due():
+         return False
+
+      with open(self.ref_state_file, "r") as f:
+         return f.read().split() == [ref_state, cursor]
+
+   def _save_ref_state(self, ref_state, cursor):
+      """Record the ref fingerprint and the cursor it was processed up to"""
+      if ref_state is None:
+         if os.path.exists(self.ref_state_file):
+            os.remove(self.ref_state_file)
+         return
+
+      with open(self.ref_state_file, "w") as f:
+         f.write("{0}\n{1}\n".format(ref_state, cursor))
+
    def _cleanup(self):
+      if not self.locked:
+         return
+
+      self.locked = False
       if not remove_pid_lock_file(self.lockfile):
          self.logger.error("Unable to remove lockfile")
          self.exit("Unable to remove lockfile. IF you are sure no other process is running you may remove the file {0} manually and try again".format(self.lockfile))
@@ -168,9 +220,61 @@ class Squeeze(object):
       self._cleanup()
       sys.exit(exitcode)
 
-   def add_handler(self, function, delta):
-      self.runner.add_handler(function, delta)
+   def add_handler(self, function, delta, cache=False):
+      self.runner.add_handler(function, delta, cache)
+
+
+def find_base_dir(startpath):
+   """Return the closest directory at or above startpath containing .squeeze
+
+      Returns None when no squeeze directory can be found.
+   """
+   checkpath = os.path.abspath(startpath)
+   prev_checkpath = None
+
+   while checkpath != prev_checkpath:
+      if os.path.isdir(os.path.join(checkpath, ".squeeze")):
+         return checkpath
+
+      prev_checkpath = checkpath
+      checkpath = os.path.dirname(checkpath)
+
+   return None
+
+def open_repo(base_dir, config, read_only=False):
+   """Return the repo for base_dir configured from the squeeze config
+
+      A read_only repo does not record anything, e.g. fs snapshots, when it
+      is queried.
+   """
+   return get_repo(
+      repo_type=config.get("repo", "git"),
+      path=base_dir,
+      rename_similarity=config.get("similarity.rename", 100),
+      copy_similarity=config.get("similarity.copy", 100),
+      diff_jobs=config.get("diff.jobs", 1),
+      submodules=config.get("submodules.enabled", False),
+      submodule_jobs=config.get("submodules.jobs", 4),
+      read_only=read_only
+      )
+
+def open_history(data_path, config):
+   """Return the history log for data_path configured from the squeeze config"""
+   return HistoryLog(
+      os.path.join(data_path, "history"),
+      segment_size=config.get("history.segment_size", 4 * 1024 * 1024),
+      max_segments=config.get("history.max_segments", 8),
+      keep=config.get("history.keep", 100)
+      )
+
+def read_last_run(data_path):
+   """Return the identifier of the last processed commit or None"""
+   latest_run = os.path.join(data_path, "latest")
+   if not os.path.exists(latest_run):
+      return None
 
+   with open(latest_run, "r") as f:
+      return f.read().strip() or None
 
 def create_pid_lock_file(filename):
    # A PID file exists we can check if we are able to remove it (i.e. the process
@@ -187,9 +291,14 @@ def remove_pid_lock_file(filename):
    with open(filename, "r") as f:
       pid = f.read().strip()
 
-   # Check if the process is still running and only remove if it is not
-   process = [p for p in psutil.get_process_list() if p.pid==pid]
-   if not process:
+   # Check if the process is still running and only remove if it is not or
+   # if the lock belongs to this process.
+   try:
+      pid = int(pid)
+   except ValueError:
+      pid = None
+
+   if pid is None or pid == os.getpid() or not psutil.pid_exists(pid):
       os.remove(filename)
       return True
    else:
@@ -205,7 +314,7 @@ class Config(object):
          raise ValueError("The file {0} is not readable".format(filename))
 
       with open(filename) as f:
-         self.config_data = yaml.load(f)
+         self.config_data = yaml.safe_load(f) or {}
 
    def get(self, value_name, default=None):
       data = self.config_data
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Cache of the blobs each handler has already processed
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import hashlib
+import os
+from collections import OrderedDict
+
+# Size in bytes of each key stored in the cache file
+KEY_SIZE = 16
+
+class BlobCache(object):
+   """Bounded set of (handler id, blob id) pairs that have been processed
+
+      Keys are stored as fixed size digests so the cache file is a flat list
+      of KEY_SIZE byte records. The least recently used keys are dropped once
+      the cache holds more than max_entries keys.
+   """
+   def __init__(self, filename, max_entries=100000):
+      self.filename = filename
+      self.max_entries = max_entries
+      self.changed = False
+
+   @property
+   def keys(self):
+      # The cache file is only read once a key is needed
+      try:
+         return self._keys
+      except AttributeError:
+         self._keys = OrderedDict()
+         if os.path.exists(self.filename):
+            with open(self.filename, "rb") as f:
+               data = f.read()
+
+            for offset in range(0, len(data) - KEY_SIZE + 1, KEY_SIZE):
+               self._keys[data[offset:offset + KEY_SIZE]] = None
+
+         return self._keys
+
+   def _key(self, handler, blob_id):
+      return hashlib.sha1((handler + "\0" + blob_id).encode("utf-8")).digest()[:KEY_SIZE]
+
+   def __len__(self):
+      return len(self.keys)
+
+   def contains(self, handler, blob_id):
+      """Return True if handler has already processed blob_id"""
+      key = self._key(handler, blob_id)
+      if key not in self.keys:
+         return False
+
+      # Move the key to the end so it is the last to be evicted
+      del self.keys[key]
+      self.keys[key] = None
+      self.changed = True
+      return True
+
+   def add(self, handler, blob_id):
+      """Record that handler has processed blob_id"""
+      key = self._key(handler, blob_id)
+      if key in self.keys:
+         del self.keys[key]
+
+      self.keys[key] = None
+      self.changed = True
+
+      while len(self.keys) > self.max_entries:
+         self.keys.popitem(last=False)
+
+   def save(self):
+      """Write the cache to disk if it has changed"""
+      if not self.changed:
+         return
+
+      tmpfile = self.filename + ".tmp"
+      with open(tmpfile, "wb") as f:
+         f.write(b"".join(self.keys))
+
+      os.rename(tmpfile, self.filename)
+      self.changed = False
@@ -0,0 +1,284 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Command line interface for squeeze
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from . import core
+from .app import (Squeeze, Config, find_base_dir, open_repo, open_history, read_last_run,
+   create_pid_lock_file, remove_pid_lock_file)
+from .journal import RetryJournal
+
+REPO_TYPES = ["git", "hg", "fs"]
+
+DEFAULT_CONFIG = """repo: {0}
+
+similarity:
+   rename: 100
+   copy: 100
+"""
+
+def main(argv=None):
+   """Entry point for the squeeze command"""
+   parser = build_parser()
+   args = parser.parse_args(argv)
+
+   if not getattr(args, "command", None):
+      return cmd_init(args)
+
+   try:
+      return args.command(args)
+   except Exception as e:
+      sys.stderr.write("ERROR " + str(e) + "\n")
+      return 1
+
+def build_parser():
+   parser = argparse.ArgumentParser(
+      prog="squeeze",
+      description="Process file changes on a VCS repository"
+      )
+   subparsers = parser.add_subparsers()
+
+   init = subparsers.add_parser("init", help="create the .squeeze directory")
+   init.add_argument("--repo", choices=REPO_TYPES, help="type of repository")
+   init.set_defaults(command=cmd_init)
+
+   diff = subparsers.add_parser(
+      "diff",
+      help="write the changes in a range without moving the cursor"
+      )
+   diff.add_argument(
+      "range", nargs="*",
+      help="A..B, A B or A. Defaults to the last processed commit up to the "
+           "newest commit"
+      )
+   add_format_argument(diff)
+   diff.set_defaults(command=cmd_diff)
+
+   run = subparsers.add_parser(
+      "run",
+      help="write the changes since the last run and move the cursor"
+      )
+   add_format_argument(run)
+   run.set_defaults(command=cmd_run)
+
+   status = subparsers.add_parser("status", help="show the squeeze state")
+   status.set_defaults(command=cmd_status)
+
+   history = subparsers.add_parser(
+      "history",
+      help="show when paths were processed or compact the history log"
+      )
+   history.add_argument("paths", nargs="*", help="paths to look up")
+   history.add_argument(
+      "--compact", action="store_true",
+      help="merge the history segments into one"
+      )
+   history.add_argument(
+      "--keep", type=int,
+      help="with --compact keep only the newest KEEP entries per path "
+           "(default: history.keep from the config)"
+      )
+   history.set_defaults(command=cmd_history)
+
+   return parser
+
+def add_format_argument(parser):
+   parser.add_argument(
+      "-f", "--format", choices=sorted(WRITERS), default="ndjson",
+      help="output format (default: ndjson)"
+      )
+   parser.add_argument(
+      "-z", dest="format", action="store_const", const="nul",
+      help="shortcut for --format nul"
+      )
+
+def cmd_init(args):
+   if os.path.exists(".squeeze"):
+      sys.stdout.write(".squeeze directory already exists\n")
+      return 0
+
+   repo = getattr(args, "repo", None)
+   while repo not in REPO_TYPES:
+      sys.stdout.write("What type of repo do you want to use? [hg|git|fs] ")
+      sys.stdout.flush()
+      repo = sys.stdin.readline().strip()
+
+   os.mkdir(".squeeze")
+   with open(os.path.join(".squeeze", "config.yml"), "w") as f:
+      f.write(DEFAULT_CONFIG.format(repo))
+
+   sys.stdout.write("Done.\n")
+   return 0
+
+def cmd_diff(args):
+   base_dir = _require_base_dir()
+   repo = open_repo(base_dir, _load_config(base_dir), read_only=True)
+
+   a, b = parse_range(args.range)
+   if a is None and not args.range:
+      a = read_last_run(os.path.join(base_dir, ".squeeze"))
+
+   if b is None:
+      b = _tip(repo)
+
+   write_changes(repo.diff(a, b), sys.stdout, args.format)
+   return 0
+
+def cmd_run(args):
+   writer = WRITERS[args.format]
+
+   def handler(delta, *files):
+      writer(delta, files, sys.stdout)
+
+   # Without a journal a failed write, such as a closed pipe, stops the run
+   # before the cursor moves instead of journaling every remaining change.
+   s = Squeeze(journal=False)
+   s.add_handler(handler, core.FILE_ANY)
+   s.run()
+   sys.stdout.flush()
+   return 0
+
+def cmd_status(args):
+   base_dir = _require_base_dir()
+   config = _load_config(base_dir)
+   repo = open_repo(base_dir, config, read_only=True)
+
+   data_path = os.path.join(base_dir, ".squeeze")
+   cursor = read_last_run(data_path)
+   journal = RetryJournal(os.path.join(data_path, "retry.json"))
+   commits = repo.commit_list or []
+   tip = commits[0] if commits else None
+
+   if cursor is None:
+      pending = len(commits)
+   elif cursor in commits:
+      pending = commits.index(cursor)
+   else:
+      pending = "unknown (cursor not in history)"
+
+   for name, value in [
+         ("base", base_dir),
+         ("repo", config.get("repo", "git")),
+         ("cursor", cursor or "(none)"),
+         ("tip", tip or "(none)"),
+         ("pending", pending),
+         ("retry", "{0} pending, {1} dead".format(len(journal.pending), len(journal.dead)))]:
+      sys.stdout.write("{0:<8} {1}\n".format(name + ":", value))
+
+   return 0
+
+def cmd_history(args):
+   base_dir = _require_base_dir()
+   data_path = os.path.join(base_dir, ".squeeze")
+   history = open_history(data_path, _load_config(base_dir))
+
+   if args.compact:
+      # Compaction rewrites every segment so it must not overlap a run that
+      # is appending to the log.
+      lockfile = os.path.join(data_path, ".lock")
+      if not create_pid_lock_file(lockfile):
+         raise ValueError("squeeze is running, try compacting again later")
+
+      try:
+         history.compact(history.keep if args.keep is None else args.keep)
+      finally:
+         remove_pid_lock_file(lockfile)
+
+   for path in args.paths:
+      for entry in history.lookup(path):
+         sys.stdout.write("\t".join([
+            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(entry.timestamp)),
+            core.DELTA_CODES[entry.delta],
+            "{0}..{1}".format(entry.a or "", entry.b or "")
+            ] + entry.files) + "\n")
+
+   return 0
+
+def parse_range(args):
+   """Convert range arguments into a tuple of (a, b)
+
+      Accepts no arguments, a single "A..B" argument, a single "A" argument
+      or two arguments "A B". Missing parts are returned as None.
+   """
+   if len(args) == 0:
+      return None, None
+   elif len(args) == 1:
+      if ".." in args[0]:
+         a, b = args[0].split("..", 1)
+         return a or None, b or None
+      return args[0], None
+   elif len(args) == 2:
+      return args[0], args[1]
+   else:
+      raise ValueError("Expected at most two range arguments")
+
+def write_changes(changes, stream, output_format="ndjson"):
+   """Write each (delta, files) change to stream in the given format"""
+   writer = WRITERS[output_format]
+   for delta, files in changes:
+      writer(delta, files, stream)
+
+   stream.flush()
+
+def write_ndjson(delta, files, stream):
+   """Write a change as a single line JSON object"""
+   stream.write(json.dumps({
+      "delta": core.DELTA_NAMES[delta],
+      "files": list(files)
+      }))
+   stream.write("\n")
+
+def write_nul(delta, files, stream):
+   """Write a change as NUL terminated fields
+
+      The record is the delta code followed by each file, the same layout
+      used by `git diff --name-status -z`.
+   """
+   stream.write(core.DELTA_CODES[delta] + "\0")
+   for path in files:
+      stream.write(path + "\0")
+
+def write_text(delta, files, stream):
+   """Write a change as a tab separated line"""
+   stream.write("\t".join([core.DELTA_CODES[delta]] + list(files)) + "\n")
+
+WRITERS = {
+   "ndjson": write_ndjson,
+   "nul": write_nul,
+   "text": write_text
+   }
+
+def _require_base_dir():
+   base_dir = find_base_dir(os.getcwd())
+   if base_dir is None:
+      raise ValueError("Unable to find squeeze basedir")
+
+   return base_dir
+
+def _load_config(base_dir):
+   config_path = os.path.join(base_dir, ".squeeze", "config.yml")
+   if not os.path.exists(config_path):
+      open(config_path, 'a').close()
+
+   return Config(config_path)
+
+def _tip(repo):
+   commits = repo.commit_list
+   if not commits:
+      raise ValueError("There are currently no commits in repo")
+
+   return commits[0]
+
+if __name__ == "__main__":
+   sys.exit(main())
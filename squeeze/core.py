@@ -15,27 +15,248 @@ FILE_MODIFIED = 0b00100 # 4
 FILE_COPIED   = 0b01000 # 8
 FILE_RENAMED  = 0b10000 # 16
 
+# Mask matching every delta type
+FILE_ANY      = 0b11111 # 31
+
+# Short codes for each delta matching the status letters used by git
+DELTA_CODES = {
+   FILE_ADDED: "A",
+   FILE_DELETED: "D",
+   FILE_MODIFIED: "M",
+   FILE_COPIED: "C",
+   FILE_RENAMED: "R"
+   }
+
+DELTA_NAMES = {
+   FILE_ADDED: "added",
+   FILE_DELETED: "deleted",
+   FILE_MODIFIED: "modified",
+   FILE_COPIED: "copied",
+   FILE_RENAMED: "renamed"
+   }
+
+def handler_id(function):
+   """Return a stable identifier for a handler function
+
+      The identifier is used to find the handler again in later runs so it is
+      built from the module and qualified name rather than the object id.
+   """
+   name = getattr(function, "__qualname__", None) or getattr(function, "__name__", repr(function))
+   return "{0}.{1}".format(getattr(function, "__module__", None), name)
+
 class DiffRunner(object):
    """Process a VCS changset calling callbacks for each"""
-   def __init__(self, repo):
-      """Initialize the DiffRunner"""
+   def __init__(self, repo, journal=None, cache=None, history=None):
+      """Initialize the DiffRunner
+
+         When a squeeze.journal.RetryJournal is given exceptions raised by
+         handlers are recorded in the journal instead of stopping the run.
+
+         When a squeeze.cache.BlobCache is given handlers added with
+         cache=True are skipped for blobs they have already processed.
+
+         When a squeeze.history.HistoryLog is given every change set is
+         appended to it once its changes have been dispatched.
+      """
       self.handlers = {}
+      self.cached_handlers = set()
+      # Handlers for every possible delta value, rebuilt by add_handler so
+      # dispatch is a single list lookup per change.
+      self._dispatch = [()] * (FILE_ANY + 1)
+      self._handler_ids = {}
       self.repo = repo
+      self.journal = journal
+      self.cache = cache
+      self.history = history
 
-   def run(self, a, b):
-      """Calls handler for each change between commits a and b"""
+   def run(self, a, b, grouped=False):
+      """Calls handler for each change between commits a and b
+
+         With grouped set the changes are dispatched grouped by delta, in the
+         order of the delta values, and each handler is called for every
+         change in a group before the next handler. This avoids most of the
+         per change overhead for large change sets but does not keep the order
+         of changes across deltas or handlers.
+      """
       if a and not self.repo.has_commit(a):
          raise ValueError('Repository does not have a commit identified by "{0}"'.format(a))
       elif b and not self.repo.has_commit(b):
          raise ValueError('Repository does not have a commit identified by "{0}"'.format(b))
 
-      changes = self.repo.diff(a, b)
+      if self.cache is not None and self.cached_handlers and self.repo.supports_raw:
+         changes = self.repo.diff(a, b, raw=True)
+      else:
+         changes = self.repo.diff(a, b)
+
+      if grouped:
+         self._run_grouped(changes)
+      elif self.journal is None and not self.cached_handlers:
+         dispatch = self._dispatch
+         for change in changes:
+            changetype = change[0]
+            for function in dispatch[changetype]:
+               function(changetype, *change[1])
+      else:
+         # Only deltas with a cached handler, or a handler with changes
+         # waiting in the journal, need the bookkeeping in _dispatch_change.
+         # Every other change is called directly and only failures are
+         # journaled.
+         dispatch = self._dispatch
+         slow = self._slow_deltas()
+         for change in changes:
+            changetype = change[0]
+            if changetype in slow:
+               for function in dispatch[changetype]:
+                  self._dispatch_change(function, change)
+               continue
+
+            for function in dispatch[changetype]:
+               try:
+                  function(changetype, *change[1])
+               except Exception as e:
+                  if self.journal is None:
+                     raise
+                  self.journal.record_failure(self._handler_id(function), changetype, change[1], e)
+
+      if self.history is not None:
+         self.history.append(a, b, changes)
+
+   def _run_grouped(self, changes):
+      # Changes are grouped by delta and number of files so handlers can be
+      # called with the files as plain positional arguments, which avoids
+      # building an argument tuple for each call.
+      dispatch = self._dispatch
+      groups = {}
+      for change in changes:
+         if dispatch[change[0]]:
+            key = (change[0], len(change[1]))
+            try:
+               groups[key].append(change)
+            except KeyError:
+               groups[key] = [change]
+
+      pending = self._pending_keys()
+      for key in sorted(groups):
+         changetype, count = key
+         group = groups[key]
+         for function in dispatch[changetype]:
+            # Journaled changes that succeed must be removed from the journal
+            # so those go through _call for every change.
+            if function in self.cached_handlers or (self._handler_id(function), changetype) in pending:
+               for change in group:
+                  self._dispatch_change(function, change)
+               continue
+
+            start = 0
+            while start is not None:
+               start = self._call_group(function, changetype, count, group, start)
+
+   def _call_group(self, function, changetype, count, group, start):
+      """Call function for group[start:] with the files as plain arguments
+
+         The whole group runs inside a single try block. When a handler
+         raises and there is a journal the failure is recorded and the index
+         to resume from is returned, otherwise None is returned once the
+         group is done.
+      """
+      i = start
+      changes = group[start:] if start else group
+      try:
+         if count == 1:
+            for i, change in enumerate(changes, start):
+               function(changetype, change[1][0])
+         elif count == 2:
+            for i, change in enumerate(changes, start):
+               src, dst = change[1]
+               function(changetype, src, dst)
+         else:
+            for i, change in enumerate(changes, start):
+               function(changetype, *change[1])
+      except Exception as e:
+         if self.journal is None:
+            raise
+
+         self.journal.record_failure(self._handler_id(function), changetype, group[i][1], e)
+         return i + 1
+
+      return None
+
+   def _pending_keys(self):
+      """Return the (handler id, delta) of every change waiting for a retry"""
+      if self.journal is None:
+         return set()
+
+      return set((x["handler"], x["delta"]) for x in self.journal.pending)
+
+   def _slow_deltas(self):
+      """Return the deltas that have a handler needing _dispatch_change"""
+      pending = self._pending_keys()
+      slow = set()
+      for delta in range(FILE_ANY + 1):
+         for function in self._dispatch[delta]:
+            if function in self.cached_handlers or (self._handler_id(function), delta) in pending:
+               slow.add(delta)
+
+      return slow
+
+   def _dispatch_change(self, function, change):
+      changetype, files = change[0], change[1]
+      # Only new content is skipped. Renames, copies and deletes keep or drop
+      # a blob but move paths, which handlers must always see.
+      if (len(change) > 2 and changetype in (FILE_ADDED, FILE_MODIFIED)
+            and function in self.cached_handlers and change[2].dst_id):
+         return self._call_cached(function, changetype, files, change[2].dst_id)
+
+      return self._call(function, changetype, files)
+
+   def retry(self, now=None):
+      """Calls the handlers for journaled changes that are due for a retry"""
+      if self.journal is None:
+         return
+
+      for entry in self.journal.due(now):
+         function = self.get_handler(entry["handler"], entry["delta"])
+         if function is None:
+            # The handler was renamed or removed so the entry can never be
+            # retried. Leaving it due would make every run look busy.
+            self.journal.mark_dead(entry, "Handler is no longer registered for this change", now)
+         else:
+            self._call(function, entry["delta"], entry["files"], now)
+
+   def _call(self, function, changetype, files, now=None):
+      """Call a handler returning True if it completed without error"""
+      if self.journal is None:
+         function(changetype, *files)
+         return True
 
-      for changetype, files in changes:
-         for function in self.get_handlers_for(changetype):
-            function(changetype, *files)
+      try:
+         function(changetype, *files)
+      except Exception as e:
+         self.journal.record_failure(self._handler_id(function), changetype, files, e, now)
+         return False
+      else:
+         if self.journal.entries:
+            self.journal.record_success(self._handler_id(function), changetype, files)
+         return True
+
+   def _handler_id(self, function):
+      try:
+         return self._handler_ids[function]
+      except KeyError:
+         return handler_id(function)
+
+   def _call_cached(self, function, changetype, files, blob_id):
+      identifier = self._handler_id(function)
+      if self.cache.contains(identifier, blob_id):
+         return True
 
-   def add_handler(self, function, delta):
+      if self._call(function, changetype, files):
+         self.cache.add(identifier, blob_id)
+         return True
+
+      return False
+
+   def add_handler(self, function, delta, cache=False):
       """Add a function to the list of handlers
 
          Available handler deltas are:
@@ -48,15 +269,42 @@ class DiffRunner(object):
          The handler function should take as parameters a delta parameter for
          the type of change and a list of positional parameters representing
          the effected files.
+
+         Setting cache to True skips the handler for added or modified files
+         whose content it has already processed, such as reverts, when the
+         runner has a cache and the repo can provide blob ids. Renames, copies
+         and deletes are always passed to the handler.
       """
+      if cache:
+         self.cached_handlers.add(function)
+
       if delta not in self.handlers:
          self.handlers[delta] = [function]
       else:
          self.handlers[delta].append(function)
 
+      self._handler_ids[function] = handler_id(function)
+      self._compile()
+
+   def _compile(self):
+      """Build the dispatch table of handlers for every delta value"""
+      dispatch = []
+      for delta in range(FILE_ANY + 1):
+         funcs = []
+         for mask in self.handlers:
+            if mask & delta:
+               funcs.extend(self.handlers[mask])
+         dispatch.append(tuple(funcs))
+
+      self._dispatch = dispatch
+
    def get_handlers_for(self, delta):
-      funcs = []
-      for index in [x for x in self.handlers if x & delta]:
-         funcs = funcs + self.handlers[index]
+      return list(self._dispatch[delta & FILE_ANY])
+
+   def get_handler(self, identifier, delta):
+      """Return the handler registered for delta with the given handler_id"""
+      for function in self.get_handlers_for(delta):
+         if handler_id(function) == identifier:
+            return function
 
-      return funcs
+      return None
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Append only log of the changes squeeze has processed
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import bisect
+import hashlib
+import os
+import re
+import struct
+import time
+from collections import namedtuple
+
+from . import core
+
+HistoryEntry = namedtuple("HistoryEntry", ["timestamp", "a", "b", "delta", "files"])
+
+# Index records are the first 8 bytes of the sha1 of a path followed by the
+# offset of the log line in the segment.
+INDEX_RECORD = struct.Struct(">QQ")
+
+CODE_DELTAS = dict((code, delta) for delta, code in core.DELTA_CODES.items())
+
+SEGMENT_NAME = re.compile(r'^seg-([0-9]+)\.log$')
+
+# Tabs and newlines separate the fields and lines of the log so they are
+# escaped, along with the escape character, in the paths written to it.
+ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n"}
+UNESCAPES = dict((escaped, char) for char, escaped in ESCAPES.items())
+ESCAPE_CHARS = re.compile(r'[\\\t\n]')
+ESCAPE_SEQUENCES = re.compile(r'\\[\\tn]')
+
+class HistoryLog(object):
+   """Log of processed changes split into segments with a path index
+
+      Changes are appended to the newest segment as tab separated lines, with
+      tabs, newlines and backslashes in paths escaped. Once a segment grows
+      past segment_size it is sealed and a sorted index of path hashes to line
+      offsets is written next to it so the history of a path can be found
+      with a binary search of each sealed segment. When
+      there are more than max_segments sealed segments they are compacted into
+      one, keeping only the newest keep entries per path (default 100) so the
+      log does not grow without bound. A keep of 0 or None keeps everything.
+   """
+   def __init__(self, directory, segment_size=4 * 1024 * 1024, max_segments=8, keep=100):
+      self.directory = directory
+      self.segment_size = segment_size
+      self.max_segments = max_segments
+      self.keep = keep
+
+   def _segments(self):
+      """Return (number, sealed) for every segment, oldest first"""
+      if not os.path.exists(self.directory):
+         return []
+
+      segments = []
+      for filename in os.listdir(self.directory):
+         match = SEGMENT_NAME.match(filename)
+         if match:
+            number = int(match.group(1))
+            segments.append((number, os.path.exists(self._path(number, "idx"))))
+
+      return sorted(segments)
+
+   def _path(self, number, extension):
+      return os.path.join(self.directory, "seg-{0:06d}.{1}".format(number, extension))
+
+   def append(self, a, b, changes, now=None):
+      """Record each (delta, files) change processed between a and b"""
+      if now is None:
+         now = time.time()
+
+      lines = []
+      for change in changes:
+         lines.append(_format_line(int(now), a, b, change[0], change[1]))
+
+      if not lines:
+         return
+
+      if not os.path.exists(self.directory):
+         os.makedirs(self.directory)
+
+      segments = self._segments()
+      if segments and not segments[-1][1]:
+         number = segments[-1][0]
+      else:
+         number = segments[-1][0] + 1 if segments else 1
+
+      with open(self._path(number, "log"), "ab") as f:
+         f.write(b"".join(lines))
+         size = f.tell()
+
+      if size >= self.segment_size:
+         self._seal(number)
+
+         if len(self._segments()) > self.max_segments:
+            self.compact(self.keep)
+
+   def _seal(self, number):
+      """Write the path index for a segment, making it read only"""
+      records = []
+      offset = 0
+      with open(self._path(number, "log"), "rb") as f:
+         for line in f:
+            for path in _parse_line(line).files:
+               records.append((_path_hash(path), offset))
+            offset += len(line)
+
+      records.sort()
+      tmpfile = self._path(number, "idx.tmp")
+      with open(tmpfile, "wb") as f:
+         for record in records:
+            f.write(INDEX_RECORD.pack(*record))
+
+      os.rename(tmpfile, self._path(number, "idx"))
+
+   def lookup(self, path):
+      """Return the HistoryEntry for every processed change to path, oldest first
+
+         Sealed segments are searched through their index but the active
+         segment has none and is read line by line, so each lookup reads up
+         to segment_size bytes of it.
+      """
+      entries = []
+      for number, sealed in self._segments():
+         if sealed:
+            entries.extend(self._lookup_sealed(number, path))
+         else:
+            with open(self._path(number, "log"), "rb") as f:
+               for line in f:
+                  entry = _parse_line(line)
+                  if path in entry.files:
+                     entries.append(entry)
+
+      return entries
+
+   def _lookup_sealed(self, number, path):
+      key = _path_hash(path)
+      entries = []
+
+      with open(self._path(number, "idx"), "rb") as index:
+         records = _IndexFile(index)
+         start = bisect.bisect_left(records, (key, 0))
+
+         offsets = []
+         for i in range(start, len(records)):
+            record = records[i]
+            if record[0] != key:
+               break
+            offsets.append(record[1])
+
+      if not offsets:
+         return entries
+
+      with open(self._path(number, "log"), "rb") as log:
+         for offset in sorted(offsets):
+            log.seek(offset)
+            entry = _parse_line(log.readline())
+            # Different paths can share a hash so check the path itself
+            if path in entry.files:
+               entries.append(entry)
+
+      return entries
+
+   def compact(self, keep=None):
+      """Merge every segment into one sealed segment
+
+         When keep is set only the newest keep entries for each path are kept.
+         An entry with several files is kept while any of them needs it.
+      """
+      segments = self._segments()
+      if not segments:
+         return
+
+      lines = []
+      for number, sealed in segments:
+         with open(self._path(number, "log"), "rb") as f:
+            lines.extend(f.readlines())
+
+      if keep:
+         counts = {}
+         kept = []
+         for line in reversed(lines):
+            needed = False
+            for path in _parse_line(line).files:
+               counts[path] = counts.get(path, 0) + 1
+               if counts[path] <= keep:
+                  needed = True
+
+            if needed:
+               kept.append(line)
+
+         lines = list(reversed(kept))
+
+      number = segments[-1][0] + 1
+      with open(self._path(number, "log.tmp"), "wb") as f:
+         f.write(b"".join(lines))
+
+      os.rename(self._path(number, "log.tmp"), self._path(number, "log"))
+      self._seal(number)
+
+      for old, sealed in segments:
+         os.remove(self._path(old, "log"))
+         if sealed:
+            os.remove(self._path(old, "idx"))
+
+class _IndexFile(object):
+   """Sequence view of an index file so bisect reads only the records it needs"""
+   def __init__(self, f):
+      self.f = f
+      f.seek(0, os.SEEK_END)
+      self.length = f.tell() // INDEX_RECORD.size
+
+   def __len__(self):
+      return self.length
+
+   def __getitem__(self, i):
+      self.f.seek(i * INDEX_RECORD.size)
+      return INDEX_RECORD.unpack(self.f.read(INDEX_RECORD.size))
+
+def _path_hash(path):
+   return struct.unpack(">Q", hashlib.sha1(_encode(path)).digest()[:8])[0]
+
+def _encode(value):
+   return value.encode("utf-8", "surrogateescape")
+
+def _escape(value):
+   return ESCAPE_CHARS.sub(lambda match: ESCAPES[match.group(0)], value)
+
+def _unescape(value):
+   return ESCAPE_SEQUENCES.sub(lambda match: UNESCAPES[match.group(0)], value)
+
+def _format_line(timestamp, a, b, delta, files):
+   fields = [str(timestamp), a or "", b or "", core.DELTA_CODES[delta]] + list(files)
+   return _encode("\t".join(_escape(x) for x in fields) + "\n")
+
+def _parse_line(line):
+   fields = line.decode("utf-8", "surrogateescape").rstrip("\n").split("\t")
+   fields = [_unescape(x) for x in fields]
+   return HistoryEntry(
+      int(fields[0]), fields[1] or None, fields[2] or None,
+      CODE_DELTAS[fields[3]], fields[4:]
+      )
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Journal of changes whose handlers failed so they can be retried
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import json
+import os
+import time
+
+class RetryJournal(object):
+   """Persistent record of handler failures
+
+      Each entry is keyed by the handler id, delta and files of the change that
+      failed. Entries are retried with an exponential backoff and once an entry
+      has failed max_attempts times it is marked dead and no longer retried.
+   """
+   def __init__(self, filename, max_attempts=5, backoff=60):
+      self.filename = filename
+      self.max_attempts = max_attempts
+      self.backoff = backoff
+      self.entries = {}
+
+      if os.path.exists(filename):
+         with open(filename, "r") as f:
+            for entry in json.load(f):
+               self.entries[self._key(entry["handler"], entry["delta"], entry["files"])] = entry
+
+   def _key(self, handler, delta, files):
+      return (handler, delta, tuple(files))
+
+   def record_failure(self, handler, delta, files, error, now=None):
+      """Add a failed change to the journal or bump its attempt count"""
+      if now is None:
+         now = time.time()
+
+      key = self._key(handler, delta, files)
+      entry = self.entries.get(key)
+      if entry is None:
+         entry = self.entries[key] = {
+            "handler": handler,
+            "delta": delta,
+            "files": list(files),
+            "attempts": 0
+            }
+
+      entry["attempts"] += 1
+      entry["error"] = "{0}: {1}".format(type(error).__name__, error)
+      entry["failed_at"] = now
+      entry["dead"] = entry["attempts"] >= self.max_attempts
+      entry["next_attempt"] = now + self.backoff * 2 ** (entry["attempts"] - 1)
+
+      return entry
+
+   def mark_dead(self, entry, reason, now=None):
+      """Stop retrying an entry, keeping it in the journal for inspection"""
+      if now is None:
+         now = time.time()
+
+      entry["error"] = reason
+      entry["failed_at"] = now
+      entry["dead"] = True
+
+   def record_success(self, handler, delta, files):
+      """Remove a change from the journal once its handler has succeeded"""
+      self.entries.pop(self._key(handler, delta, files), None)
+
+   def due(self, now=None):
+      """Return the entries that should be retried now"""
+      if now is None:
+         now = time.time()
+
+      return [
+         x for x in self.entries.values()
+         if not x["dead"] and x["next_attempt"] <= now
+         ]
+
+   @property
+   def pending(self):
+      return [x for x in self.entries.values() if not x["dead"]]
+
+   @property
+   def dead(self):
+      return [x for x in self.entries.values() if x["dead"]]
+
+   def save(self):
+      """Write the journal to disk, removing the file when it is empty"""
+      if not self.entries:
+         if os.path.exists(self.filename):
+            os.remove(self.filename)
+         return
+
+      # Write to a temporary file first so a crash can not leave a partial
+      # journal behind.
+      tmpfile = self.filename + ".tmp"
+      with open(tmpfile, "w") as f:
+         json.dump(sorted(self.entries.values(), key=lambda x: x["failed_at"]), f, indent=1)
+
+      os.rename(tmpfile, self.filename)
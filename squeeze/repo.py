@@ -8,7 +8,15 @@
 # Author: Ryan Kadwell <ryan@riaka.ca>
 #
 
+import hashlib
+import multiprocessing
+import os
 import re
+import shutil
+import tempfile
+import zlib
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from . import core
 from .util import Command
 
@@ -18,17 +26,34 @@ def get_repo(repo_type, path, **kwargs):
       This method is a factory constructor for creating different repository
       classes.
 
-      Currently supported VCSs are Git and Mercurial.
+      Currently supported VCSs are Git and Mercurial. Directories that are
+      not under version control can use the "fs" type.
    """
    repo_type = repo_type.lower()
    if repo_type == "git":
       return GitRepo(path, **kwargs)
    elif repo_type == "hg" or repo_type == "mercurial":
       return HgRepo(path, **kwargs)
+   elif repo_type == "fs":
+      return FsRepo(path, **kwargs)
    else:
       raise ValueError("Unsupported repo_type \"{0}\" provided".format(repo_type))
 
+# Modes and object ids for both sides of a change. Sides that do not exist
+# (the source of an added file or the destination of a deleted one) are None.
+Blob = namedtuple("Blob", ["src_mode", "dst_mode", "src_id", "dst_id"])
+
+NULL_MODE = "000000"
+GITLINK_MODE = "160000"
+NULL_ID = "0" * 40
+
+# Most top level files diffed by one partition when diff_jobs is above 1
+PARTITION_FILES = 1000
+
 class BaseRepo(object):
+   # Whether diff() accepts raw=True to include the Blob for each change
+   supports_raw = False
+
    def __init__(self, path, **kwargs):
       self.base_path = path
       # different repo's might have different options so just treat them all
@@ -44,8 +69,18 @@ class BaseRepo(object):
    def has_commit(self, identifier):
       return identifier in self.commit_list
 
+   def ref_state(self):
+      """Return a fingerprint of the repo's refs without running the VCS
+
+         The fingerprint changes whenever commit_list could change. None is
+         returned when it can not be read cheaply, in which case callers must
+         assume something may have changed.
+      """
+      return None
+
 # Our representation of a git repository
 class GitRepo(BaseRepo):
+   supports_raw = True
 
    @property
    def commit_list(self):
@@ -65,7 +100,64 @@ class GitRepo(BaseRepo):
 
          return self._commit_list
 
-   def diff(self, a, b):
+   def ref_state(self):
+      """Fingerprint HEAD and every ref read directly from the git directory
+
+         commit_list uses `git rev-list --all` so every ref counts, not just
+         the current branch. Loose refs and packed-refs are read as plain
+         files which only costs a few stat and read calls.
+      """
+      try:
+         git_dir, common_dir = self._git_dirs()
+         if git_dir is None or os.path.exists(os.path.join(common_dir, "reftable")):
+            return None
+
+         state = hashlib.sha1()
+         state.update(_read_bytes(os.path.join(git_dir, "HEAD")))
+
+         packed_refs = os.path.join(common_dir, "packed-refs")
+         if os.path.exists(packed_refs):
+            state.update(_read_bytes(packed_refs))
+
+         refs_dir = os.path.join(common_dir, "refs")
+         for root, dirs, files in os.walk(refs_dir):
+            dirs.sort()
+            for name in sorted(files):
+               if name.endswith(".lock"):
+                  continue
+
+               path = os.path.join(root, name)
+               state.update(os.path.relpath(path, refs_dir).encode("utf-8") + b"\0")
+               state.update(_read_bytes(path))
+      except (IOError, OSError):
+         return None
+
+      return state.hexdigest()
+
+   def _git_dirs(self):
+      """Return the git directory and the common directory holding refs
+
+         These differ for linked worktrees where .git is a file pointing to
+         the worktree's git directory.
+      """
+      git_dir = os.path.join(self.base_path, ".git")
+      if os.path.isfile(git_dir):
+         content = _read_bytes(git_dir).decode("utf-8").strip()
+         if not content.startswith("gitdir:"):
+            return None, None
+
+         git_dir = os.path.join(self.base_path, content[len("gitdir:"):].strip())
+      elif not os.path.isdir(git_dir):
+         return None, None
+
+      common_dir = git_dir
+      commondir_file = os.path.join(git_dir, "commondir")
+      if os.path.exists(commondir_file):
+         common_dir = os.path.join(git_dir, _read_bytes(commondir_file).decode("utf-8").strip())
+
+      return git_dir, common_dir
+
+   def diff(self, a, b, raw=False):
       """Returns diff data representing delta required to from commit a to b
 
          diff will return an array of tuples in the format (DELTA, [files])
@@ -76,8 +168,22 @@ class GitRepo(BaseRepo):
          squeeze.core.FILE_MODIFIED
          squeeze.core.FILE_COPIED
          squeeze.core.FILE_RENAMED
+
+         When raw is True the tuples are (DELTA, [files], Blob) with the modes
+         and blob ids of the change taken from `git diff --raw`.
+
+         When the diff_jobs option is above 1 the tree is split at the top
+         level and each part is diffed by a separate concurrent git process.
+
+         When the submodules option is set, changes to submodule commits are
+         replaced by the file changes between the old and new commits of the
+         submodule, with paths prefixed by the submodule path.
       """
-      changes = []
+      jobs = self.diff_jobs
+      submodules = self.get_option('submodules', False)
+
+      # Submodules are found by their gitlink mode so need raw output
+      use_raw = raw or submodules
 
       if not a:
          if not b:
@@ -90,40 +196,401 @@ class GitRepo(BaseRepo):
             commit = b
 
          # Everything in repo is new since we dont have a starting point
-         returncode, stdout, stderr = Command.run(
-            ['git', 'ls-tree', '-r', commit, '--name-only'],
-            cwd=self.base_path
-         )
-
-         if not returncode == 0:
-            self.exit('Unable to list the git tree to file files in project')
-
-         for line in stdout:
-            changes.append((core.FILE_ADDED, [line]))
+         if jobs > 1:
+            changes = self._run_partitioned(
+               lambda paths: self._list_tree(commit, use_raw, paths),
+               self._partitions([commit])
+               )
+         else:
+            changes = self._list_tree(commit, use_raw)
       elif a == b:
          # Nothing to do.
-         pass
+         changes = []
       else:
          if not b:
             b = "HEAD"
 
          diff = "{0}..{1}".format(a, b)
+         if jobs > 1:
+            # Partitions always use raw output as the blob ids are needed to
+            # match renames and copies. Partitions do not detect renames
+            # themselves so every pairing is made across the whole diff, the
+            # same way the serial diff would make it.
+            changes = self._run_partitioned(
+               lambda paths: self._diff_paths(diff, True, paths, renames=False),
+               self._partitions([a, b])
+               )
+            changes = self._match_across_partitions(changes)
+         else:
+            changes = self._diff_paths(diff, use_raw)
+
+      if submodules:
+         changes = self._expand_submodules(changes)
+
+      if not raw:
+         changes = [(change[0], change[1]) for change in changes]
+
+      return changes
+
+   def _expand_submodules(self, changes):
+      """Replace submodule changes with the file changes inside them
+
+         Each submodule is diffed by its own GitRepo on a pool of
+         submodule_jobs threads (default 4). Submodule repos get the same
+         options except that they diff and expand nested submodules with a
+         single job, so the number of git processes stays bounded by
+         submodule_jobs however deep the nesting is. Submodules that are not
+         checked out or do not have the commits needed are left as a single
+         change.
+      """
+      expand = [
+         i for i, change in enumerate(changes)
+         if change[0] in (core.FILE_ADDED, core.FILE_DELETED, core.FILE_MODIFIED)
+            and GITLINK_MODE in (change[2].src_mode, change[2].dst_mode)
+         ]
+
+      if not expand:
+         return changes
+
+      jobs = min(self.get_option('submodule_jobs', 4), len(expand))
+      pool = ThreadPool(jobs)
+      try:
+         results = pool.map(lambda i: self._submodule_changes(changes[i]), expand)
+      finally:
+         pool.close()
+         pool.join()
+
+      expanded = dict(zip(expand, results))
+      result = []
+      for i, change in enumerate(changes):
+         if expanded.get(i) is not None:
+            result.extend(expanded[i])
+         else:
+            result.append(change)
+
+      return result
+
+   def _submodule_changes(self, change):
+      changetype, files, blob = change
+      path = files[0]
+      options = dict(self.options, submodule_jobs=1, diff_jobs=1)
+      submodule = GitRepo(os.path.join(self.base_path, path), **options)
+      if submodule._git_dirs()[0] is None:
+         return None
+
+      try:
+         if changetype == core.FILE_ADDED:
+            changes = submodule.diff(None, blob.dst_id, raw=True)
+         elif changetype == core.FILE_DELETED:
+            changes = [
+               (core.FILE_DELETED, x[1], Blob(x[2].dst_mode, None, x[2].dst_id, None))
+               for x in submodule.diff(None, blob.src_id, raw=True)
+               ]
+         else:
+            changes = submodule.diff(blob.src_id, blob.dst_id, raw=True)
+      except Exception:
+         return None
+
+      return [
+         (x[0], [path + "/" + f for f in x[1]], x[2])
+         for x in changes
+         ]
+
+   @property
+   def diff_jobs(self):
+      """Number of concurrent git processes to use when computing a diff
+
+         Set with the diff_jobs option. A value of 0 uses one job per cpu.
+      """
+      jobs = self.get_option('diff_jobs', 1)
+      if not jobs:
+         jobs = multiprocessing.cpu_count()
+
+      return int(jobs)
+
+   def _list_tree(self, commit, raw, paths=None):
+      """Return every file in commit as an added change"""
+      if raw:
+         command = ['git', '--literal-pathspecs', 'ls-tree', '-r', '-z', commit]
+      else:
+         command = ['git', '--literal-pathspecs', 'ls-tree', '-r', '-z', commit, '--name-only']
+
+      if paths:
+         command = command + ['--'] + paths
+
+      returncode, stdout, stderr = Command.run(command, cwd=self.base_path, separator="\0")
+
+      if not returncode == 0:
+         raise Exception('Unable to list the git tree to file files in project')
+
+      if raw:
+         return self._parse_tree(stdout)
+      else:
+         return [(core.FILE_ADDED, [line]) for line in stdout]
+
+   def _diff_paths(self, diff, raw, paths=None, renames=True):
+      """Return the changes in the diff range limited to paths
+
+         With renames set to False git does not detect renames or copies.
+      """
+      if raw:
+         command = ['git', '--literal-pathspecs', 'diff', '--raw', '--no-abbrev', '-z']
+      else:
+         command = ['git', '--literal-pathspecs', 'diff', '--name-status', '-z']
+
+      command = command + (['-C'] if renames else ['--no-renames']) + [diff]
+
+      if paths:
+         command = command + ['--'] + paths
+
+      returncode, stdout, stderr = Command.run(command, cwd=self.base_path, separator="\0")
+
+      if not returncode == 0:
+         raise Exception("Unable to find changed files")
+
+      # With -z paths are never quoted and every field is NUL terminated
+      if raw:
+         return self._parse_raw_fields(stdout)
+      else:
+         return self._parse_diff_fields(stdout)
+
+   def _partitions(self, commits):
+      """Split the top level of the given commits into lists of paths
+
+         Every top level directory is its own partition and runs of top level
+         files are grouped together. Partitions are returned in the order git
+         sorts the tree so joining their output keeps the serial ordering.
+      """
+      entries = {}
+      for commit in commits:
+         # -z keeps git from quoting names, which would then not match as
+         # literal pathspecs.
          returncode, stdout, stderr = Command.run(
-            ['git', 'diff', '--name-status', '-C', diff],
-            cwd=self.base_path
+            ['git', 'ls-tree', '-z', commit],
+            cwd=self.base_path,
+            separator="\0"
          )
 
          if not returncode == 0:
-            raise Exception("Unable to find changed files")
+            raise Exception("Unable to list the git tree for {0}".format(commit))
+
+         for line in stdout:
+            meta, name = line.split("\t", 1)
+            if meta.split(" ")[1] == "tree":
+               entries[name] = name + "/"
+            else:
+               entries.setdefault(name, name)
+
+      partitions = []
+      files = []
+      for name in sorted(entries, key=lambda x: entries[x]):
+         if entries[name].endswith("/"):
+            if files:
+               partitions.append(files)
+               files = []
+            partitions.append([name])
+         else:
+            files.append(name)
+            # Keep the command line of each partition a reasonable length
+            if len(files) >= PARTITION_FILES:
+               partitions.append(files)
+               files = []
+
+      if files:
+         partitions.append(files)
 
-         changes = self._parse_diff(stdout)
+      return partitions
+
+   def _run_partitioned(self, func, partitions):
+      """Call func for each partition concurrently and join the results"""
+      if len(partitions) < 2:
+         return func(None)
+
+      pool = ThreadPool(min(self.diff_jobs, len(partitions)))
+      try:
+         results = pool.map(func, partitions)
+      finally:
+         pool.close()
+         pool.join()
+
+      changes = []
+      for result in results:
+         changes.extend(result)
 
       return changes
 
-   def _parse_diff(self, lines):
+   def _match_across_partitions(self, changes):
+      """Pair adds with deletes or modifications to find renames and copies
+
+         Partitions are diffed without rename detection, as a diff limited to
+         one partition can not see sources in other partitions, so renames
+         and copies show up as separate adds and deletes. Exact matches are
+         paired by blob id. Inexact matches are only possible when a
+         similarity option is below 100 and are found by a final git diff
+         between trees holding only the unmatched files.
+      """
+      added = [i for i, x in enumerate(changes) if x[0] == core.FILE_ADDED]
+      if not added:
+         return changes
+
+      # Indexes of deleted files and contents that can be copied, by blob id
+      deleted = {}
+      sources = {}
+      for i, (changetype, files, blob) in enumerate(changes):
+         if changetype == core.FILE_DELETED:
+            deleted.setdefault(blob.src_id, []).append(i)
+         elif changetype == core.FILE_MODIFIED:
+            sources.setdefault(blob.src_id, files[0])
+
+      replaced = {}
+      removed = set()
+      for i in added:
+         changetype, files, blob = changes[i]
+         if deleted.get(blob.dst_id):
+            # The first add of a deleted blob is a rename and any later adds
+            # of the same blob are copies of it.
+            j = deleted[blob.dst_id].pop(0)
+            src_files, src_blob = changes[j][1], changes[j][2]
+            replaced[i] = (core.FILE_RENAMED, [src_files[0], files[0]],
+               Blob(src_blob.src_mode, blob.dst_mode, src_blob.src_id, blob.dst_id))
+            removed.add(j)
+            sources.setdefault(blob.dst_id, src_files[0])
+         elif blob.dst_id in sources:
+            replaced[i] = (core.FILE_COPIED, [sources[blob.dst_id], files[0]],
+               Blob(blob.dst_mode, blob.dst_mode, blob.dst_id, blob.dst_id))
+
+      if (self.get_option('rename_similarity', 100) < 100
+            or self.get_option('copy_similarity', 100) < 100):
+         self._match_inexact(changes, replaced, removed)
+
+      return [
+         replaced.get(i, change) for i, change in enumerate(changes)
+         if i not in removed
+         ]
+
+   def _match_inexact(self, changes, replaced, removed):
+      # Build one tree with the old side and one with the new side of every
+      # unmatched change and let git find the renames and copies between
+      # them. Paths go through stdin so there is no limit on their number.
+      old_entries = []
+      new_entries = []
+      targets = {}
+      sources = {}
+      for i, (changetype, files, blob) in enumerate(changes):
+         if i in replaced or i in removed:
+            continue
+
+         if changetype == core.FILE_ADDED:
+            new_entries.append((blob.dst_mode, blob.dst_id, files[0]))
+            targets[files[0]] = i
+         elif changetype == core.FILE_DELETED:
+            old_entries.append((blob.src_mode, blob.src_id, files[0]))
+            sources[files[0]] = i
+         elif changetype == core.FILE_MODIFIED:
+            old_entries.append((blob.src_mode, blob.src_id, files[0]))
+            new_entries.append((blob.dst_mode, blob.dst_id, files[0]))
+
+      if not targets or not old_entries:
+         return
+
+      diff = "{0}..{1}".format(self._write_tree(old_entries), self._write_tree(new_entries))
+      for changetype, files, blob in self._diff_paths(diff, True):
+         if changetype not in (core.FILE_RENAMED, core.FILE_COPIED):
+            continue
+
+         dst = targets.get(files[1])
+         if dst is None:
+            continue
+
+         replaced[dst] = (changetype, files, blob)
+         if changetype == core.FILE_RENAMED and files[0] in sources:
+            removed.add(sources[files[0]])
+
+   def _write_tree(self, entries):
+      """Write a tree object holding (mode, object id, path) entries
+
+         A temporary index is used so the repo's own index is untouched. The
+         tree is left in the object database for git gc to clean up.
+      """
+      tmpdir = tempfile.mkdtemp()
+      try:
+         env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmpdir, "index"))
+         index_info = "".join(
+            "{0} {1}\t{2}\0".format(mode, objid, path) for mode, objid, path in entries
+            )
+
+         returncode, stdout, stderr = Command.run(
+            ['git', 'update-index', '-z', '--index-info'],
+            cwd=self.base_path, input=index_info, env=env
+         )
+         if returncode == 0:
+            returncode, stdout, stderr = Command.run(
+               ['git', 'write-tree'], cwd=self.base_path, env=env
+            )
+
+         if not returncode == 0:
+            raise Exception("Unable to write a tree to match renames")
+
+         return stdout[0]
+      finally:
+         shutil.rmtree(tmpdir)
+
+   def _parse_tree(self, lines):
+      """Parse `git ls-tree -r` records into added changes with their Blob"""
       changes = []
       for line in lines:
-         changes = changes + self._parse_diff_line(line)
+         meta, path = line.split("\t", 1)
+         mode, objtype, objid = meta.split(" ")
+         changes.append((core.FILE_ADDED, [path], Blob(None, mode, None, objid)))
+
+      return changes
+
+   def _parse_raw_fields(self, fields):
+      """Parse the fields of `git diff --raw -z` into changes with their Blob
+
+         Each change is a ":<src mode> <dst mode> <src id> <dst id> <status>"
+         field followed by one path, or two for renames and copies.
+      """
+      changes = []
+      i = 0
+      while i < len(fields):
+         src_mode, dst_mode, src_id, dst_id, status = fields[i].lstrip(":").split(" ")
+         count = _path_count(status)
+         files = fields[i + 1:i + 1 + count]
+         i += 1 + count
+
+         blob = Blob(
+            None if src_mode == NULL_MODE else src_mode,
+            None if dst_mode == NULL_MODE else dst_mode,
+            None if src_id == NULL_ID else src_id,
+            None if dst_id == NULL_ID else dst_id
+            )
+
+         for changetype, changed in self._parse_status(status, files):
+            changes.append((changetype, changed, blob))
+
+      return changes
+
+   def _parse_diff(self, lines):
+      fields = []
+      for line in lines:
+         fields.extend(re.split(r'\t+', line.strip()))
+
+      return self._parse_diff_fields(fields)
+
+   def _parse_diff_fields(self, fields):
+      """Parse the fields of `git diff --name-status -z` into changes
+
+         Each change is a status field followed by one path, or two for
+         renames and copies.
+      """
+      changes = []
+      i = 0
+      while i < len(fields):
+         status = fields[i]
+         count = _path_count(status)
+         changes.extend(self._parse_status(status, fields[i + 1:i + 1 + count]))
+         i += 1 + count
 
       return changes
 
@@ -134,13 +601,11 @@ class GitRepo(BaseRepo):
          change type as the first parameter and an array of effected files as
          the second parameter.
       """
-      # TODO This does not respect tabs in filenames. Tho rare and discouraged
-      # it is allowed and should be handled properly.
       parts = re.split(r'\t+', line.strip())
+      return self._parse_status(parts[0], parts[1:])
 
-      changetype = parts[0]
-      files = parts[1:]
-
+   def _parse_status(self, changetype, files):
+      """Convert a git status letter and its files into changes"""
       if changetype == "A":
          return [(core.FILE_ADDED, files)]
 
@@ -164,6 +629,13 @@ class GitRepo(BaseRepo):
          else:
             return [(core.FILE_ADDED, [files[1]])]
 
+      elif changetype == "T":
+         # The file type changed, e.g. a file was replaced by a symlink
+         return [(core.FILE_MODIFIED, files)]
+
+      # Unmerged or unknown changes are not reported
+      return []
+
 # Our representation of a mercurial repository
 class HgRepo(BaseRepo):
 
@@ -185,6 +657,24 @@ class HgRepo(BaseRepo):
 
          return self._commit_list
 
+   def ref_state(self):
+      """Fingerprint the mercurial changelog
+
+         Every commit appends to the changelog so its size and modification
+         time change whenever `hg log` would list a new revision.
+      """
+      for changelog in [
+            os.path.join(self.base_path, ".hg", "store", "00changelog.i"),
+            os.path.join(self.base_path, ".hg", "00changelog.i")]:
+         try:
+            info = os.stat(changelog)
+         except OSError:
+            continue
+
+         return "{0} {1} {2}".format(changelog, info.st_size, info.st_mtime)
+
+      return None
+
    def diff(self, a, b):
       changes = []
 
@@ -264,3 +754,315 @@ class HgRepo(BaseRepo):
                   diff['ADDED'].remove([last_added])
 
       return diff
+
+# Snapshot entry for a file in an FsRepo. The hash is "" until the file has
+# been seen changing since it is only computed when the stat data changes.
+FsEntry = namedtuple("FsEntry", ["size", "mtime", "inode", "hash"])
+
+# Our representation of a plain directory that is not under version control
+class FsRepo(BaseRepo):
+   """Repo that detects changes by comparing snapshots of the file system
+
+      Every scan of the directory is stored as a snapshot in the index
+      directory (.squeeze/fs by default) and the snapshot ids play the part of
+      commit identifiers. Only stat data is read for files that are unchanged
+      since the previous snapshot. Files that are new or whose stat data
+      changed are hashed, except during the first scan, so touched files can
+      be told apart from modified ones and renames can be matched by hash when
+      the inode differs.
+
+      Options:
+      index_path     -- directory holding the snapshots
+      keep_snapshots -- number of snapshots to keep (default 20)
+      cursor_file    -- file holding the last processed snapshot id, which is
+                        never pruned (default .squeeze/latest)
+      read_only      -- scan without recording the snapshot (default False)
+   """
+   def __init__(self, path, **kwargs):
+      super(FsRepo, self).__init__(path, **kwargs)
+      self.index_path = self.get_option(
+         'index_path', os.path.join(path, ".squeeze", "fs")
+         )
+      self._snapshots = {}
+
+   @property
+   def history_file(self):
+      return os.path.join(self.index_path, "history")
+
+   @property
+   def commit_list(self):
+      """Return the snapshot ids newest first
+
+         The first access scans the directory and records a new snapshot if
+         anything changed since the newest one. With the read_only option the
+         new snapshot is only kept in memory.
+      """
+      try:
+         return self._commit_list
+      except AttributeError:
+         history = self._read_history()
+         previous = self._load_snapshot(history[0]) if history else {}
+
+         snapshot = self._scan(previous)
+         snapshot_id = self._snapshot_id(snapshot)
+
+         if not history or history[0] != snapshot_id:
+            history = [snapshot_id] + [x for x in history if x != snapshot_id]
+            if not self.get_option('read_only', False):
+               self._write_snapshot(snapshot_id, snapshot)
+               history = self._prune(history)
+               self._write_history(history)
+
+         self._snapshots[snapshot_id] = snapshot
+         self._commit_list = history
+
+         return self._commit_list
+
+   def diff(self, a, b):
+      changes = []
+
+      if not b:
+         b = self.commit_list[0]
+      elif not self.has_commit(b):
+         raise Exception("Invalid commit identifier {0}".format(b))
+
+      if not a:
+         # Everything in the snapshot is new since we dont have a starting point
+         for path in sorted(self._load_snapshot(b)):
+            changes.append((core.FILE_ADDED, [path]))
+      elif a == b:
+         # Nothing to do.
+         pass
+      else:
+         changes = self._compare(self._load_snapshot(a), self._load_snapshot(b))
+
+      return changes
+
+   def _compare(self, old, new):
+      changes = []
+      added = []
+      deleted = []
+
+      for path in sorted(new):
+         entry = new[path]
+         if path not in old:
+            added.append(path)
+         elif not _same_content(old[path], entry):
+            changes.append((core.FILE_MODIFIED, [path]))
+
+      for path in sorted(old):
+         if path not in new:
+            deleted.append(path)
+
+      # A file with the inode of a deleted file was moved, and also modified
+      # unless its content is the same. Otherwise a file whose content hash
+      # matches a deleted file is treated as a rename.
+      by_inode = {}
+      by_hash = {}
+      for path in deleted:
+         entry = old[path]
+         by_inode[entry.inode] = path
+         if entry.hash:
+            by_hash.setdefault(entry.hash, path)
+
+      renamed = set()
+      for path in added:
+         entry = new[path]
+         src = by_inode.get(entry.inode)
+         if src is None or src in renamed:
+            src = by_hash.get(entry.hash) if entry.hash else None
+
+         if src is not None and src not in renamed:
+            renamed.add(src)
+            changes.append((core.FILE_RENAMED, [src, path]))
+            if not _same_content(old[src], entry):
+               changes.append((core.FILE_MODIFIED, [path]))
+         else:
+            changes.append((core.FILE_ADDED, [path]))
+
+      for path in deleted:
+         if path not in renamed:
+            changes.append((core.FILE_DELETED, [path]))
+
+      return changes
+
+   def _scan(self, previous):
+      """Walk the directory returning a snapshot dict of path to FsEntry
+
+         Files that disappear during the walk are left out. Directories that
+         can not be read keep the entries of the previous snapshot and files
+         that can not be read are kept without a hash, so neither is reported
+         as deleted.
+      """
+      snapshot = {}
+      changed = []
+      ignore = os.path.abspath(os.path.join(self.base_path, ".squeeze"))
+      stack = [(self.base_path, "")]
+
+      while stack:
+         directory, prefix = stack.pop()
+         try:
+            items = list(os.scandir(directory))
+         except FileNotFoundError:
+            continue
+         except OSError:
+            for path, entry in previous.items():
+               if path.startswith(prefix):
+                  snapshot[path] = entry
+            continue
+
+         for item in items:
+            path = prefix + item.name
+            try:
+               if item.is_dir(follow_symlinks=False):
+                  if os.path.abspath(item.path) != ignore:
+                     stack.append((item.path, path + "/"))
+                  continue
+
+               if not (item.is_file(follow_symlinks=False) or item.is_symlink()):
+                  continue
+
+               info = item.stat(follow_symlinks=False)
+            except OSError:
+               continue
+
+            entry = FsEntry(info.st_size, info.st_mtime_ns, item.inode(), "")
+
+            old = previous.get(path)
+            if old is not None and old[:3] == entry[:3]:
+               # Unchanged stat data so the old hash is still valid
+               entry = old
+            elif previous:
+               changed.append(path)
+
+            snapshot[path] = entry
+
+      # Files moved within the file system keep their inode and stat data so
+      # they take the hash of the file they were moved from without reading.
+      moved = {}
+      for path, old in previous.items():
+         if path not in snapshot:
+            moved[(old.inode, old.size, old.mtime)] = old
+
+      for path in changed:
+         entry = snapshot[path]
+         old = moved.get((entry.inode, entry.size, entry.mtime))
+         if old is not None:
+            snapshot[path] = old
+         else:
+            full_path = os.path.join(self.base_path, path)
+            try:
+               snapshot[path] = entry._replace(hash=self._hash_path(full_path))
+            except FileNotFoundError:
+               del snapshot[path]
+            except OSError:
+               pass
+
+      return snapshot
+
+   def _hash_path(self, path):
+      digest = hashlib.sha1()
+      if os.path.islink(path):
+         digest.update(os.readlink(path).encode("utf-8", "surrogateescape"))
+      else:
+         with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+               digest.update(block)
+
+      return digest.hexdigest()
+
+   def _snapshot_id(self, snapshot):
+      digest = hashlib.sha1()
+      for path in sorted(snapshot):
+         entry = snapshot[path]
+         digest.update("{0}\t{1}\t{2}\t{3}\0".format(
+            entry.size, entry.mtime, entry.inode, path
+            ).encode("utf-8", "surrogateescape"))
+
+      return digest.hexdigest()
+
+   def _load_snapshot(self, snapshot_id):
+      if snapshot_id in self._snapshots:
+         return self._snapshots[snapshot_id]
+
+      snapshot = {}
+      data = zlib.decompress(_read_bytes(os.path.join(self.index_path, snapshot_id)))
+      for record in data.decode("utf-8", "surrogateescape").split("\0"):
+         if not record:
+            continue
+
+         size, mtime, inode, filehash, path = record.split("\t", 4)
+         snapshot[path] = FsEntry(int(size), int(mtime), int(inode), filehash)
+
+      self._snapshots[snapshot_id] = snapshot
+      return snapshot
+
+   def _write_snapshot(self, snapshot_id, snapshot):
+      """Write a snapshot as compressed NUL separated records"""
+      if not os.path.exists(self.index_path):
+         os.makedirs(self.index_path)
+
+      records = []
+      for path in sorted(snapshot):
+         entry = snapshot[path]
+         records.append("{0}\t{1}\t{2}\t{3}\t{4}".format(
+            entry.size, entry.mtime, entry.inode, entry.hash, path
+            ))
+
+      data = zlib.compress("\0".join(records).encode("utf-8", "surrogateescape"))
+      tmpfile = os.path.join(self.index_path, snapshot_id + ".tmp")
+      with open(tmpfile, "wb") as f:
+         f.write(data)
+
+      os.rename(tmpfile, os.path.join(self.index_path, snapshot_id))
+
+   def _read_history(self):
+      if not os.path.exists(self.history_file):
+         return []
+
+      with open(self.history_file, "r") as f:
+         return [x.strip() for x in f if x.strip()]
+
+   def _write_history(self, history):
+      with open(self.history_file, "w") as f:
+         f.write("".join(x + "\n" for x in history))
+
+   def _read_cursor(self):
+      cursor_file = self.get_option(
+         'cursor_file', os.path.join(self.base_path, ".squeeze", "latest")
+         )
+      if not os.path.exists(cursor_file):
+         return None
+
+      with open(cursor_file, "r") as f:
+         return f.read().strip() or None
+
+   def _prune(self, history):
+      # The snapshot of the last run is kept however old it is, otherwise the
+      # next run could not diff against it.
+      keep = self.get_option('keep_snapshots', 20)
+      cursor = self._read_cursor()
+      for snapshot_id in history[keep:]:
+         if snapshot_id == cursor:
+            continue
+
+         path = os.path.join(self.index_path, snapshot_id)
+         if os.path.exists(path):
+            os.remove(path)
+
+      return history[:keep] + [x for x in history[keep:] if x == cursor]
+
+def _path_count(status):
+   # Renames and copies list the source and destination paths
+   return 2 if status[:1] in ("R", "C") else 1
+
+def _same_content(old, new):
+   if old[:3] == new[:3]:
+      return True
+
+   # Stat data changed but the content may not have, e.g. after a touch
+   return bool(old.hash) and old.hash == new.hash
+
+def _read_bytes(path):
+   with open(path, "rb") as f:
+      return f.read()
@@ -14,24 +14,40 @@ class Command(object):
    """Wrapper for subprocess.Popen"""
 
    @staticmethod
-   def run(args, cwd="."):
+   def run(args, cwd=".", separator="\n", input=None, env=None):
       """Wrap subprocess.Popen command execution
 
          Runs a command using subprocess and return a tuple containing the
-         return code, stdout, stderr.
+         return code, stdout, stderr. stdout is split on separator, which can
+         be set to "\0" for commands run with -z. input is written to the
+         command's stdin and env replaces its environment.
       """
       proc = subprocess.Popen(
-         args, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd
+         args, stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd,
+         stdin=subprocess.PIPE if input is not None else None, env=env
       )
 
-      proc.wait() # wait for command to finish before we carry on
+      # communicate() drains both pipes while waiting so commands with large
+      # output (big diffs or tree listings) can not block on a full pipe.
+      if input is not None:
+         input = input.encode("utf-8", "surrogateescape")
+      out, err = proc.communicate(input)
 
-      stdout = []
-      for line in proc.stdout:
-         stdout.append(line.rstrip('\n'))
-
-      stderr = []
-      for line in proc.stderr:
-         stderr.append(line.rstrip('\n'))
+      stdout = _split_output(_decode(out), separator)
+      stderr = _split_output(_decode(err), "\n")
 
       return proc.returncode, stdout, stderr
+
+def _decode(output):
+   # Output is decoded without newline translation and bytes that are not
+   # valid utf-8 are kept as surrogates so file names round trip.
+   return output.decode("utf-8", "surrogateescape")
+
+def _split_output(output, separator):
+   # Only split on the separator. str.splitlines() would also break on
+   # characters such as \r or \x0b which are valid in file names.
+   lines = output.split(separator)
+   if lines and lines[-1] == '':
+      lines.pop()
+
+   return lines
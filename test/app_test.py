@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the squeeze.app runner
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from squeeze import *
+from squeeze.app import Squeeze
+from squeeze.util import Command
+
+class SqueezeRunTest(unittest.TestCase):
+   """Runs against a real git repository to check when VCS commands run"""
+
+   def setUp(self):
+      self.cwd = os.getcwd()
+      self.tmpdir = tempfile.mkdtemp()
+      self.git("init", "-q")
+      with open(os.path.join(self.tmpdir, "file1"), "w") as f:
+         f.write("one")
+      self.git("add", "file1")
+      self.git("commit", "-q", "-m", "c1")
+
+      os.mkdir(os.path.join(self.tmpdir, ".squeeze"))
+      with open(os.path.join(self.tmpdir, ".squeeze", "config.yml"), "w") as f:
+         f.write("repo: git\n")
+
+      os.chdir(self.tmpdir)
+      self.changes = []
+      self.squeeze().run()
+
+   def tearDown(self):
+      os.chdir(self.cwd)
+      shutil.rmtree(self.tmpdir)
+
+   def git(self, *args):
+      env = dict(os.environ,
+         GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@b",
+         GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@b")
+      subprocess.check_call(("git",) + args, cwd=self.tmpdir, env=env)
+
+   def squeeze(self):
+      s = Squeeze()
+      s.add_handler(lambda delta, *files: self.changes.append((delta, list(files))), FILE_ANY)
+      return s
+
+   def test_first_run_processes_changes(self):
+      self.assertEqual([(FILE_ADDED, ["file1"])], self.changes)
+
+   def test_idle_run_does_not_run_commands(self):
+      with mock.patch.object(Command, "run", side_effect=AssertionError("VCS command run")):
+         self.squeeze().run()
+
+      self.assertFalse(os.path.exists(os.path.join(".squeeze", ".lock")))
+
+   def test_run_with_retry_due_takes_full_path(self):
+      s = self.squeeze()
+      s.journal.record_failure("handler", FILE_ADDED, ["file1"], ValueError("x"), now=time.time() - 3600)
+      s.journal.save()
+
+      with mock.patch.object(Command, "run", wraps=Command.run) as run:
+         self.squeeze().run()
+
+      self.assertTrue(run.called)
+
+   def test_run_without_cursor_takes_full_path(self):
+      os.remove(os.path.join(".squeeze", "latest"))
+
+      with mock.patch.object(Command, "run", wraps=Command.run) as run:
+         self.squeeze().run()
+
+      self.assertTrue(run.called)
+      self.assertEqual([(FILE_ADDED, ["file1"])] * 2, self.changes)
+
+   def test_rewound_cursor_takes_full_path(self):
+      with open(os.path.join(self.tmpdir, "file2"), "w") as f:
+         f.write("two")
+      self.git("add", "file2")
+      self.git("commit", "-q", "-m", "c2")
+      self.squeeze().run()
+
+      first = subprocess.check_output(["git", "rev-parse", "HEAD~1"], cwd=self.tmpdir)
+      with open(os.path.join(".squeeze", "latest"), "w") as f:
+         f.write(first.decode("utf-8").strip())
+      self.squeeze().run()
+
+      self.assertEqual([
+         (FILE_ADDED, ["file1"]),
+         (FILE_ADDED, ["file2"]),
+         (FILE_ADDED, ["file2"])
+      ], self.changes)
+
+   def test_new_commit_takes_full_path(self):
+      with open(os.path.join(self.tmpdir, "file2"), "w") as f:
+         f.write("two")
+      self.git("add", "file2")
+      self.git("commit", "-q", "-m", "c2")
+
+      self.squeeze().run()
+
+      self.assertEqual([(FILE_ADDED, ["file1"]), (FILE_ADDED, ["file2"])], self.changes)
+
+   def test_failure_without_journal_stops_run(self):
+      with open(os.path.join(self.tmpdir, "file2"), "w") as f:
+         f.write("two")
+      self.git("add", "file2")
+      self.git("commit", "-q", "-m", "c2")
+
+      with open(os.path.join(".squeeze", "latest")) as f:
+         cursor = f.read()
+
+      def handler(delta, *files):
+         raise BrokenPipeError(32, "Broken pipe")
+
+      s = Squeeze(journal=False)
+      s.add_handler(handler, FILE_ANY)
+      with mock.patch("sys.stderr"):
+         self.assertRaises(SystemExit, s.run)
+
+      with open(os.path.join(".squeeze", "latest")) as f:
+         self.assertEqual(cursor, f.read())
+      self.assertFalse(os.path.exists(os.path.join(".squeeze", "retry.json")))
+      self.assertFalse(os.path.exists(os.path.join(".squeeze", ".lock")))
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the blob cache
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from squeeze import *
+from squeeze.cache import BlobCache, KEY_SIZE
+from squeeze.core import DiffRunner
+from squeeze.repo import Blob
+
+from fake_repo import FakeRepo
+
+class BlobCacheTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.filename = os.path.join(self.tmpdir, "blobcache")
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def test_keys_are_per_handler(self):
+      cache = BlobCache(self.filename)
+      cache.add("h1", "a" * 40)
+
+      self.assertTrue(cache.contains("h1", "a" * 40))
+      self.assertFalse(cache.contains("h2", "a" * 40))
+
+   def test_evicts_least_recently_used(self):
+      cache = BlobCache(self.filename, max_entries=2)
+      cache.add("h", "1")
+      cache.add("h", "2")
+      cache.contains("h", "1")
+      cache.add("h", "3")
+
+      self.assertTrue(cache.contains("h", "1"))
+      self.assertFalse(cache.contains("h", "2"))
+      self.assertEqual(2, len(cache))
+
+   def test_save_and_load(self):
+      cache = BlobCache(self.filename)
+      cache.add("h", "1")
+      cache.add("h", "2")
+      cache.save()
+
+      self.assertEqual(2 * KEY_SIZE, os.path.getsize(self.filename))
+
+      cache = BlobCache(self.filename)
+      self.assertTrue(cache.contains("h", "1"))
+      self.assertTrue(cache.contains("h", "2"))
+
+class DiffRunnerCacheTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.cache = BlobCache(os.path.join(self.tmpdir, "blobcache"))
+      self.calls = []
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def handler(self, delta, *files):
+      self.calls.append(files[-1])
+
+   def test_skips_seen_blobs(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["file1"], Blob(None, "100644", None, "a" * 40)),
+         (FILE_ADDED, ["file2"], Blob(None, "100644", None, "a" * 40)),
+         (FILE_MODIFIED, ["file3"], Blob("100644", "100644", "b" * 40, "c" * 40)),
+         (FILE_MODIFIED, ["file4"], Blob("100644", "100644", "d" * 40, "a" * 40))
+      ], raw=True), cache=self.cache)
+      runner.add_handler(self.handler, FILE_ANY, cache=True)
+      runner.run("a", "b")
+
+      self.assertEqual(["file1", "file3"], self.calls)
+
+   def test_renames_and_copies_are_not_skipped(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["file1"], Blob(None, "100644", None, "a" * 40)),
+         (FILE_RENAMED, ["file1", "file2"], Blob("100644", "100644", "a" * 40, "a" * 40)),
+         (FILE_COPIED, ["file2", "file3"], Blob("100644", "100644", "a" * 40, "a" * 40)),
+         (FILE_ADDED, ["file4"], Blob(None, "100644", None, "a" * 40))
+      ], raw=True), cache=self.cache)
+      runner.add_handler(self.handler, FILE_ANY, cache=True)
+      runner.run("a", "b")
+
+      self.assertEqual(["file1", "file2", "file3"], self.calls)
+
+   def test_uncached_handler_sees_every_change(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["file1"], Blob(None, "100644", None, "a" * 40)),
+         (FILE_ADDED, ["file2"], Blob(None, "100644", None, "a" * 40))
+      ], raw=True), cache=self.cache)
+      runner.add_handler(self.handler, FILE_ANY)
+      runner.run("a", "b")
+
+      self.assertEqual(["file1", "file2"], self.calls)
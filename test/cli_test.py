@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the squeeze command line interface
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from squeeze import *
+from squeeze import cli
+from squeeze.history import HistoryLog
+
+class ParseRangeTest(unittest.TestCase):
+
+   def test_no_arguments(self):
+      self.assertEqual((None, None), cli.parse_range([]))
+
+   def test_dotted_range(self):
+      self.assertEqual(("abc", "def"), cli.parse_range(["abc..def"]))
+
+   def test_open_ended_dotted_range(self):
+      self.assertEqual(("abc", None), cli.parse_range(["abc.."]))
+      self.assertEqual((None, "def"), cli.parse_range(["..def"]))
+
+   def test_single_argument(self):
+      self.assertEqual(("abc", None), cli.parse_range(["abc"]))
+
+   def test_two_arguments(self):
+      self.assertEqual(("abc", "def"), cli.parse_range(["abc", "def"]))
+
+   def test_too_many_arguments(self):
+      self.assertRaises(ValueError, cli.parse_range, ["a", "b", "c"])
+
+class WriteChangesTest(unittest.TestCase):
+
+   changes = [
+      (FILE_ADDED, ["file1"]),
+      (FILE_RENAMED, ["file2", "file3"])
+   ]
+
+   def test_write_ndjson(self):
+      stream = io.StringIO()
+      cli.write_changes(self.changes, stream, "ndjson")
+
+      lines = stream.getvalue().splitlines()
+      self.assertEqual([
+         {"delta": "added", "files": ["file1"]},
+         {"delta": "renamed", "files": ["file2", "file3"]}
+      ], [json.loads(line) for line in lines])
+
+   def test_write_nul(self):
+      stream = io.StringIO()
+      cli.write_changes(self.changes, stream, "nul")
+
+      self.assertEqual("A\0file1\0R\0file2\0file3\0", stream.getvalue())
+
+   def test_write_text(self):
+      stream = io.StringIO()
+      cli.write_changes(self.changes, stream, "text")
+
+      self.assertEqual("A\tfile1\nR\tfile2\tfile3\n", stream.getvalue())
+
+class HistoryCommandTest(unittest.TestCase):
+
+   def setUp(self):
+      self.cwd = os.getcwd()
+      self.tmpdir = tempfile.mkdtemp()
+      self.data_path = os.path.join(self.tmpdir, ".squeeze")
+      os.mkdir(self.data_path)
+      os.chdir(self.tmpdir)
+
+      self.history = HistoryLog(os.path.join(self.data_path, "history"))
+      self.history.append("c1", "c2", [(FILE_ADDED, ["file1"])], now=1)
+
+   def tearDown(self):
+      os.chdir(self.cwd)
+      shutil.rmtree(self.tmpdir)
+
+   def test_compact(self):
+      self.assertEqual(0, cli.main(["history", "--compact"]))
+      self.assertEqual(1, len(self.history.lookup("file1")))
+      self.assertFalse(os.path.exists(os.path.join(self.data_path, ".lock")))
+
+   def test_compact_waits_for_running_squeeze(self):
+      # The parent process stands in for a running squeeze holding the lock
+      with open(os.path.join(self.data_path, ".lock"), "w") as f:
+         f.write(str(os.getppid()))
+
+      with mock.patch("sys.stderr"):
+         self.assertEqual(1, cli.main(["history", "--compact"]))
+
+      self.assertEqual(["seg-000001.log"], sorted(os.listdir(os.path.join(self.data_path, "history"))))
@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the squeeze.core classes
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import unittest
+
+from squeeze import *
+from squeeze.core import DiffRunner
+
+from fake_repo import FakeRepo
+
+class DiffRunnerTest(unittest.TestCase):
+
+   changes = [
+      (FILE_MODIFIED, ["file1"]),
+      (FILE_ADDED, ["file2"]),
+      (FILE_RENAMED, ["file3", "file4"]),
+      (FILE_ADDED, ["file5"])
+   ]
+
+   def setUp(self):
+      self.calls = []
+      self.runner = DiffRunner(FakeRepo(self.changes))
+
+   def handler(self, name):
+      def handle(delta, *files):
+         self.calls.append((name, delta) + files)
+      return handle
+
+   def test_get_handlers_for(self):
+      add, any_change, modify = self.handler("add"), self.handler("any"), self.handler("modify")
+      self.runner.add_handler(add, FILE_ADDED)
+      self.runner.add_handler(any_change, FILE_ANY)
+      self.runner.add_handler(modify, FILE_MODIFIED | FILE_ADDED)
+
+      self.assertEqual([add, any_change, modify], self.runner.get_handlers_for(FILE_ADDED))
+      self.assertEqual([any_change, modify], self.runner.get_handlers_for(FILE_MODIFIED))
+      self.assertEqual([any_change], self.runner.get_handlers_for(FILE_RENAMED))
+      self.assertEqual([], DiffRunner(None).get_handlers_for(FILE_ADDED))
+
+   def test_run_keeps_change_order(self):
+      self.runner.add_handler(self.handler("add"), FILE_ADDED)
+      self.runner.add_handler(self.handler("any"), FILE_ANY)
+      self.runner.run("a", "b")
+
+      self.assertEqual([
+         ("any", FILE_MODIFIED, "file1"),
+         ("add", FILE_ADDED, "file2"),
+         ("any", FILE_ADDED, "file2"),
+         ("any", FILE_RENAMED, "file3", "file4"),
+         ("add", FILE_ADDED, "file5"),
+         ("any", FILE_ADDED, "file5")
+      ], self.calls)
+
+   def test_run_grouped(self):
+      self.runner.add_handler(self.handler("add"), FILE_ADDED)
+      self.runner.add_handler(self.handler("any"), FILE_ANY)
+      self.runner.run("a", "b", grouped=True)
+
+      self.assertEqual([
+         ("add", FILE_ADDED, "file2"),
+         ("add", FILE_ADDED, "file5"),
+         ("any", FILE_ADDED, "file2"),
+         ("any", FILE_ADDED, "file5"),
+         ("any", FILE_MODIFIED, "file1"),
+         ("any", FILE_RENAMED, "file3", "file4")
+      ], self.calls)
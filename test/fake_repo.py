@@ -0,0 +1,28 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Repo stand in shared by the tests
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+class FakeRepo(object):
+   """Repo that returns the same changes for every diff
+
+      With raw set the changes are (delta, files, blob) tuples and diff()
+      drops the blob unless it is called with raw=True.
+   """
+   def __init__(self, changes, raw=False):
+      self.changes = changes
+      self.supports_raw = raw
+
+   def has_commit(self, identifier):
+      return True
+
+   def diff(self, a, b, raw=False):
+      if self.supports_raw and not raw:
+         return [(delta, files) for delta, files, blob in self.changes]
+
+      return self.changes
@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the processed change history log
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from squeeze import *
+from squeeze.core import DiffRunner
+from squeeze.history import HistoryLog, HistoryEntry
+
+from fake_repo import FakeRepo
+
+class HistoryLogTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.directory = os.path.join(self.tmpdir, "history")
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def fill(self, history):
+      history.append(None, "c1", [(FILE_ADDED, ["file1"]), (FILE_ADDED, ["file2"])], now=1)
+      history.append("c1", "c2", [(FILE_RENAMED, ["file1", "file3"])], now=2)
+      history.append("c2", "c3", [(FILE_MODIFIED, ["file3"])], now=3)
+
+   def test_lookup_active_segment(self):
+      history = HistoryLog(self.directory)
+      self.fill(history)
+
+      self.assertEqual([
+         HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["file1", "file3"]),
+         HistoryEntry(3, "c2", "c3", FILE_MODIFIED, ["file3"])
+      ], history.lookup("file3"))
+
+   def test_lookup_sealed_segments(self):
+      history = HistoryLog(self.directory, segment_size=1)
+      self.fill(history)
+
+      self.assertEqual(3, len([x for x in os.listdir(self.directory) if x.endswith(".idx")]))
+      self.assertEqual([
+         HistoryEntry(1, None, "c1", FILE_ADDED, ["file1"]),
+         HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["file1", "file3"])
+      ], history.lookup("file1"))
+      self.assertEqual([], history.lookup("file4"))
+
+   def test_paths_with_separators(self):
+      paths = ["tab\there", "new\nline", "back\\slash\\t"]
+      for segment_size in (4096, 1):
+         history = HistoryLog(os.path.join(self.directory, str(segment_size)), segment_size=segment_size)
+         history.append(None, "c1", [(FILE_ADDED, [x]) for x in paths], now=1)
+         history.append("c1", "c2", [(FILE_RENAMED, paths[:2])], now=2)
+
+         self.assertEqual([
+            HistoryEntry(1, None, "c1", FILE_ADDED, ["new\nline"]),
+            HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["tab\there", "new\nline"])
+         ], history.lookup("new\nline"))
+         self.assertEqual([
+            HistoryEntry(1, None, "c1", FILE_ADDED, ["back\\slash\\t"])
+         ], history.lookup("back\\slash\\t"))
+
+   def test_compact_keeps_newest_per_path(self):
+      history = HistoryLog(self.directory, segment_size=1)
+      self.fill(history)
+      history.compact(keep=1)
+
+      self.assertEqual(["seg-000004.idx", "seg-000004.log"], sorted(os.listdir(self.directory)))
+      # The rename is still the newest entry for file1 so it is kept
+      self.assertEqual([
+         HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["file1", "file3"])
+      ], history.lookup("file1"))
+      self.assertEqual([
+         HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["file1", "file3"]),
+         HistoryEntry(3, "c2", "c3", FILE_MODIFIED, ["file3"])
+      ], history.lookup("file3"))
+      self.assertEqual([
+         HistoryEntry(1, None, "c1", FILE_ADDED, ["file2"])
+      ], history.lookup("file2"))
+
+   def test_automatic_compaction(self):
+      history = HistoryLog(self.directory, segment_size=1, max_segments=2)
+      self.fill(history)
+
+      self.assertEqual(2, len(os.listdir(self.directory)))
+      self.assertEqual(2, len(history.lookup("file3")))
+
+   def test_automatic_compaction_drops_old_entries(self):
+      history = HistoryLog(self.directory, segment_size=1, max_segments=2, keep=1)
+      self.fill(history)
+
+      self.assertEqual([
+         HistoryEntry(2, "c1", "c2", FILE_RENAMED, ["file1", "file3"])
+      ], history.lookup("file1"))
+
+   def test_default_keep_is_bounded(self):
+      history = HistoryLog(self.directory, segment_size=1, max_segments=1)
+      for i in range(150):
+         history.append("c1", "c2", [(FILE_MODIFIED, ["file1"])], now=i)
+
+      entries = history.lookup("file1")
+      self.assertTrue(len(entries) <= 101)
+      self.assertEqual(149, entries[-1].timestamp)
+
+   def test_runner_appends_change_set(self):
+      history = HistoryLog(self.directory)
+      runner = DiffRunner(FakeRepo([(FILE_DELETED, ["file1"])]), history=history)
+      runner.run("c1", "c2")
+
+      entries = history.lookup("file1")
+      self.assertEqual(1, len(entries))
+      self.assertEqual(("c1", "c2", FILE_DELETED), entries[0][1:4])
@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+#
+# Squeeze
+# Copyright (c) Ryan Kadwell <ryan@riaka.ca>
+#
+# Tests for the retry journal
+#
+# Author: Ryan Kadwell <ryan@riaka.ca>
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from squeeze import *
+from squeeze.core import DiffRunner, handler_id
+from squeeze.journal import RetryJournal
+
+from fake_repo import FakeRepo
+
+class RetryJournalTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.filename = os.path.join(self.tmpdir, "retry.json")
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def test_backoff_doubles_each_attempt(self):
+      journal = RetryJournal(self.filename, backoff=10)
+
+      entry = journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"), now=100)
+      self.assertEqual(110, entry["next_attempt"])
+
+      entry = journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"), now=200)
+      self.assertEqual(2, entry["attempts"])
+      self.assertEqual(220, entry["next_attempt"])
+      self.assertEqual("ValueError: x", entry["error"])
+
+   def test_due(self):
+      journal = RetryJournal(self.filename, backoff=10)
+      journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"), now=100)
+
+      self.assertEqual([], journal.due(now=105))
+      self.assertEqual(1, len(journal.due(now=110)))
+
+   def test_dead_after_max_attempts(self):
+      journal = RetryJournal(self.filename, max_attempts=2, backoff=0)
+      journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"), now=100)
+      journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"), now=100)
+
+      self.assertEqual([], journal.due(now=1000))
+      self.assertEqual(1, len(journal.dead))
+
+   def test_success_removes_entry(self):
+      journal = RetryJournal(self.filename)
+      journal.record_failure("h", FILE_ADDED, ["file1"], ValueError("x"))
+      journal.record_success("h", FILE_ADDED, ["file1"])
+
+      self.assertEqual([], journal.pending)
+
+   def test_save_and_load(self):
+      journal = RetryJournal(self.filename)
+      journal.record_failure("h", FILE_RENAMED, ["file1", "file2"], ValueError("x"), now=100)
+      journal.save()
+
+      journal = RetryJournal(self.filename)
+      self.assertEqual(1, len(journal.pending))
+      self.assertEqual(["file1", "file2"], journal.pending[0]["files"])
+
+      journal.record_success("h", FILE_RENAMED, ["file1", "file2"])
+      journal.save()
+      self.assertFalse(os.path.exists(self.filename))
+
+class DiffRunnerRetryTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.journal = RetryJournal(os.path.join(self.tmpdir, "retry.json"), backoff=10)
+      self.calls = []
+      self.fail = set(["bad"])
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def handler(self, delta, *files):
+      if files[0] in self.fail:
+         raise ValueError(files[0])
+      self.calls.append(files[0])
+
+   def test_failure_does_not_stop_run(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["good1"]),
+         (FILE_ADDED, ["bad"]),
+         (FILE_ADDED, ["good2"])
+      ]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED)
+      runner.run("a", "b")
+
+      self.assertEqual(["good1", "good2"], self.calls)
+      self.assertEqual(1, len(self.journal.pending))
+      self.assertEqual(handler_id(self.handler), self.journal.pending[0]["handler"])
+
+   def test_grouped_failure_does_not_stop_group(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["good1"]),
+         (FILE_ADDED, ["bad"]),
+         (FILE_ADDED, ["good2"]),
+         (FILE_MODIFIED, ["good3"])
+      ]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED | FILE_MODIFIED)
+      runner.run("a", "b", grouped=True)
+
+      self.assertEqual(["good1", "good2", "good3"], self.calls)
+      self.assertEqual(1, len(self.journal.pending))
+      self.assertEqual(["bad"], self.journal.pending[0]["files"])
+
+   def test_grouped_success_removes_journaled_change(self):
+      self.journal.record_failure(handler_id(self.handler), FILE_ADDED, ["good1"], ValueError("x"))
+      runner = DiffRunner(FakeRepo([(FILE_ADDED, ["good1"])]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED)
+      runner.run("a", "b", grouped=True)
+
+      self.assertEqual(["good1"], self.calls)
+      self.assertEqual([], self.journal.pending)
+
+   def test_success_removes_journaled_change(self):
+      self.journal.record_failure(handler_id(self.handler), FILE_ADDED, ["good1"], ValueError("x"))
+      runner = DiffRunner(FakeRepo([(FILE_ADDED, ["good1"]), (FILE_ADDED, ["bad"])]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED)
+      runner.run("a", "b")
+
+      self.assertEqual(["good1"], self.calls)
+      self.assertEqual([["bad"]], [x["files"] for x in self.journal.pending])
+
+   def test_only_pending_entries_need_bookkeeping(self):
+      runner = DiffRunner(FakeRepo([]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED | FILE_MODIFIED)
+
+      self.journal.record_failure("other.handler", FILE_ADDED, ["file1"], ValueError("x"))
+      entry = self.journal.record_failure(handler_id(self.handler), FILE_ADDED, ["file2"], ValueError("x"))
+      self.journal.mark_dead(entry, "x")
+      self.assertEqual(set(), runner._slow_deltas())
+
+      self.journal.record_failure(handler_id(self.handler), FILE_MODIFIED, ["file3"], ValueError("x"))
+      self.assertEqual(set([FILE_MODIFIED]), runner._slow_deltas())
+
+   def test_retry_only_journaled_changes(self):
+      runner = DiffRunner(FakeRepo([
+         (FILE_ADDED, ["good1"]),
+         (FILE_ADDED, ["bad"])
+      ]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED)
+      runner.run("a", "b")
+
+      self.calls = []
+      self.fail = set()
+      runner.retry(now=self.journal.pending[0]["next_attempt"])
+
+      self.assertEqual(["bad"], self.calls)
+      self.assertEqual([], self.journal.pending)
+
+   def test_failure_raises_without_journal(self):
+      runner = DiffRunner(FakeRepo([(FILE_ADDED, ["bad"])]))
+      runner.add_handler(self.handler, FILE_ADDED)
+
+      self.assertRaises(ValueError, runner.run, "a", "b")
+
+   def test_unregistered_handler_is_marked_dead(self):
+      self.journal.record_failure("missing.handler", FILE_ADDED, ["bad"], ValueError("x"), now=100)
+      runner = DiffRunner(FakeRepo([]), self.journal)
+      runner.add_handler(self.handler, FILE_ADDED)
+      runner.retry(now=1000)
+
+      self.assertEqual([], self.journal.due(now=1000))
+      self.assertEqual(1, len(self.journal.dead))
+      self.assertEqual([], self.calls)
@@ -8,7 +8,12 @@
 # Author: Ryan Kadwell <ryan@riaka.ca>
 #
 
+import os
+import shutil
+import subprocess
+import tempfile
 import unittest
+from unittest import mock
 
 from squeeze import *
 from squeeze import repo
@@ -182,3 +187,407 @@ class GitRepoTest(unittest.TestCase):
       self.assertEquals(result, [
          (FILE_COPIED, ["file1", "file2"])
       ])
+
+   def test_parse_raw_fields(self):
+      fields = [
+         ":000000 100644 " + "0" * 40 + " " + "a" * 40 + " A", "file1",
+         ":100644 100644 " + "b" * 40 + " " + "c" * 40 + " M", "file\t2",
+         ":100644 100755 " + "d" * 40 + " " + "d" * 40 + " R100", "file3", "file\n4"
+      ]
+
+      d = repo.GitRepo("")
+      result = d._parse_raw_fields(fields)
+
+      self.assertEqual(result, [
+         (FILE_ADDED, ["file1"], repo.Blob(None, "100644", None, "a" * 40)),
+         (FILE_MODIFIED, ["file\t2"], repo.Blob("100644", "100644", "b" * 40, "c" * 40)),
+         (FILE_RENAMED, ["file3", "file\n4"], repo.Blob("100644", "100755", "d" * 40, "d" * 40))
+      ])
+
+   def test_parse_tree(self):
+      tree_lines = [
+         "100644 blob " + "a" * 40 + "\tdir/file1"
+      ]
+
+      d = repo.GitRepo("")
+      result = d._parse_tree(tree_lines)
+
+      self.assertEqual(result, [
+         (FILE_ADDED, ["dir/file1"], repo.Blob(None, "100644", None, "a" * 40))
+      ])
+
+   def test_match_renames_and_copies_across_partitions(self):
+      changes = [
+         (FILE_DELETED, ["dir1/file1"], repo.Blob("100644", None, "a" * 40, None)),
+         (FILE_MODIFIED, ["dir1/file2"], repo.Blob("100644", "100644", "b" * 40, "c" * 40)),
+         (FILE_ADDED, ["dir2/file1"], repo.Blob(None, "100644", None, "a" * 40)),
+         (FILE_ADDED, ["dir2/file2"], repo.Blob(None, "100644", None, "b" * 40)),
+         (FILE_ADDED, ["dir3/file1"], repo.Blob(None, "100644", None, "a" * 40)),
+         (FILE_ADDED, ["dir3/file3"], repo.Blob(None, "100644", None, "d" * 40))
+      ]
+
+      d = repo.GitRepo("")
+      result = [x[:2] for x in d._match_across_partitions(changes)]
+
+      self.assertEqual(result, [
+         (FILE_MODIFIED, ["dir1/file2"]),
+         (FILE_RENAMED, ["dir1/file1", "dir2/file1"]),
+         (FILE_COPIED, ["dir1/file2", "dir2/file2"]),
+         (FILE_COPIED, ["dir1/file1", "dir3/file1"]),
+         (FILE_ADDED, ["dir3/file3"])
+      ])
+
+class FakeSubmoduleRepo(repo.GitRepo):
+   def _submodule_changes(self, change):
+      if change[1][0] == "missing":
+         return None
+
+      return [
+         (FILE_MODIFIED, [change[1][0] + "/file1"], change[2]),
+         (FILE_ADDED, [change[1][0] + "/file2"], change[2])
+      ]
+
+class GitSubmoduleTest(unittest.TestCase):
+
+   def test_expand_submodules(self):
+      gitlink = repo.Blob("160000", "160000", "a" * 40, "b" * 40)
+      changes = [
+         (FILE_ADDED, ["file1"], repo.Blob(None, "100644", None, "c" * 40)),
+         (FILE_MODIFIED, ["lib1"], gitlink),
+         (FILE_MODIFIED, ["missing"], gitlink),
+         (FILE_MODIFIED, ["lib2"], gitlink)
+      ]
+
+      d = FakeSubmoduleRepo("", submodule_jobs=2)
+      result = [x[:2] for x in d._expand_submodules(changes)]
+
+      self.assertEqual(result, [
+         (FILE_ADDED, ["file1"]),
+         (FILE_MODIFIED, ["lib1/file1"]),
+         (FILE_ADDED, ["lib1/file2"]),
+         (FILE_MODIFIED, ["missing"]),
+         (FILE_MODIFIED, ["lib2/file1"]),
+         (FILE_ADDED, ["lib2/file2"])
+      ])
+
+   def test_nested_submodules_use_one_job(self):
+      gitlink = repo.Blob("160000", "160000", "a" * 40, "b" * 40)
+      d = repo.GitRepo("base", submodules=True, submodule_jobs=4, diff_jobs=8)
+
+      with mock.patch.object(repo, "GitRepo") as submodule:
+         d._submodule_changes((FILE_MODIFIED, ["lib"], gitlink))
+
+      submodule.assert_called_once_with(
+         os.path.join("base", "lib"), submodules=True, submodule_jobs=1, diff_jobs=1)
+
+class GitRepoDiffTest(unittest.TestCase):
+   """Diffs of a real git repository with names git would normally quote"""
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.git("init", "-q")
+      os.makedirs(os.path.join(self.tmpdir, "dir \u00e9"))
+      self.write("d\u00e9j\u00e0.txt", "one")
+      self.write("tab\there", "two")
+      self.write("dir \u00e9/f", "three")
+      self.write("plain", "four")
+      self.commit("c1")
+
+      os.rename(os.path.join(self.tmpdir, "plain"), os.path.join(self.tmpdir, "dir \u00e9/moved"))
+      self.write("dir \u00e9/f", "changed")
+      self.write("new\nline", "five")
+      self.commit("c2")
+
+      self.c1, self.c2 = self.git("rev-parse", "HEAD~1", "HEAD").split()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def git(self, *args):
+      env = dict(os.environ,
+         GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@b",
+         GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@b")
+      return subprocess.check_output(("git",) + args, cwd=self.tmpdir, env=env).decode("utf-8")
+
+   def write(self, path, content):
+      with open(os.path.join(self.tmpdir, path), "w") as f:
+         f.write(content)
+
+   def commit(self, message):
+      self.git("add", "-A")
+      self.git("commit", "-q", "-m", message)
+
+   def test_initial_diff_is_not_quoted(self):
+      result = repo.GitRepo(self.tmpdir).diff(None, self.c1)
+
+      self.assertEqual(sorted(result), [
+         (FILE_ADDED, ["dir \u00e9/f"]),
+         (FILE_ADDED, ["d\u00e9j\u00e0.txt"]),
+         (FILE_ADDED, ["plain"]),
+         (FILE_ADDED, ["tab\there"])
+      ])
+
+   def test_diff_is_not_quoted(self):
+      result = repo.GitRepo(self.tmpdir).diff(self.c1, self.c2)
+
+      self.assertEqual(sorted(result), [
+         (FILE_ADDED, ["new\nline"]),
+         (FILE_MODIFIED, ["dir \u00e9/f"]),
+         (FILE_RENAMED, ["plain", "dir \u00e9/moved"])
+      ])
+
+   def test_raw_diff_is_not_quoted(self):
+      result = repo.GitRepo(self.tmpdir).diff(self.c1, self.c2, raw=True)
+
+      self.assertEqual(sorted(x[:2] for x in result), [
+         (FILE_ADDED, ["new\nline"]),
+         (FILE_MODIFIED, ["dir \u00e9/f"]),
+         (FILE_RENAMED, ["plain", "dir \u00e9/moved"])
+      ])
+
+   def test_partitioned_diff_matches_serial_diff(self):
+      serial = repo.GitRepo(self.tmpdir)
+      partitioned = repo.GitRepo(self.tmpdir, diff_jobs=2)
+
+      self.assertEqual(
+         sorted(partitioned.diff(None, self.c1)),
+         sorted(serial.diff(None, self.c1)))
+      self.assertEqual(
+         sorted(partitioned.diff(self.c1, self.c2)),
+         sorted(serial.diff(self.c1, self.c2)))
+
+   def test_partitioned_diff_matches_inexact_renames(self):
+      lines = "".join("line {0}\n".format(i) for i in range(20))
+      self.write("d\u00e9j\u00e0.txt", lines)
+      self.commit("c3")
+      os.makedirs(os.path.join(self.tmpdir, "other"))
+      os.remove(os.path.join(self.tmpdir, "d\u00e9j\u00e0.txt"))
+      self.write("other/d\u00e9j\u00e0.txt", lines + "line 20\n")
+      self.commit("c4")
+
+      c3, c4 = self.git("rev-parse", "HEAD~1", "HEAD").split()
+      result = repo.GitRepo(self.tmpdir, diff_jobs=2, rename_similarity=50).diff(c3, c4)
+
+      self.assertEqual(result, [
+         (FILE_RENAMED, ["d\u00e9j\u00e0.txt", "other/d\u00e9j\u00e0.txt"])
+      ])
+
+   def test_partitioned_inexact_matches_serial_diff(self):
+      two = ["line {0}\n".format(i) for i in range(20)]
+      three = two[:13] + ["other {0}\n".format(i) for i in range(13, 20)]
+      for directory in ("a", "b", "c"):
+         os.makedirs(os.path.join(self.tmpdir, directory))
+      self.write("a/keep", "keep")
+      self.write("b/two", "".join(two))
+      self.write("c/three", "".join(three))
+      self.commit("c3")
+
+      os.remove(os.path.join(self.tmpdir, "c/three"))
+      self.write("a/three2", "".join(three[:-1]) + "changed\n")
+      self.write("b/two", "".join(two[:-1]) + "changed\n")
+      self.write("c/twocopy", "".join(two[1:]))
+      self.commit("c4")
+
+      c3, c4 = self.git("rev-parse", "HEAD~1", "HEAD").split()
+      options = dict(rename_similarity=50, copy_similarity=50)
+      serial = repo.GitRepo(self.tmpdir, **options).diff(c3, c4)
+      partitioned = repo.GitRepo(self.tmpdir, diff_jobs=2, **options).diff(c3, c4)
+
+      self.assertEqual(sorted(serial), [
+         (FILE_MODIFIED, ["b/two"]),
+         (FILE_COPIED, ["b/two", "c/twocopy"]),
+         (FILE_RENAMED, ["c/three", "a/three2"])
+      ])
+      self.assertEqual(sorted(partitioned), sorted(serial))
+
+class GitRefStateTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      self.git_dir = os.path.join(self.tmpdir, ".git")
+      os.makedirs(os.path.join(self.git_dir, "refs", "heads"))
+      self.write(".git/HEAD", "ref: refs/heads/master\n")
+      self.write(".git/refs/heads/master", "a" * 40 + "\n")
+      self.repo = repo.GitRepo(self.tmpdir)
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def write(self, path, content):
+      with open(os.path.join(self.tmpdir, path), "w") as f:
+         f.write(content)
+
+   def test_unchanged_refs_have_same_state(self):
+      self.assertEqual(self.repo.ref_state(), self.repo.ref_state())
+
+   def test_loose_ref_change(self):
+      state = self.repo.ref_state()
+      self.write(".git/refs/heads/master", "b" * 40 + "\n")
+      self.assertNotEqual(state, self.repo.ref_state())
+
+   def test_new_branch(self):
+      state = self.repo.ref_state()
+      self.write(".git/refs/heads/feature", "a" * 40 + "\n")
+      self.assertNotEqual(state, self.repo.ref_state())
+
+   def test_packed_refs_change(self):
+      state = self.repo.ref_state()
+      self.write(".git/packed-refs", "b" * 40 + " refs/tags/v1\n")
+      self.assertNotEqual(state, self.repo.ref_state())
+
+   def test_worktree_git_file(self):
+      state = self.repo.ref_state()
+      worktree = os.path.join(self.tmpdir, "worktree")
+      os.makedirs(worktree)
+      self.write("worktree/.git", "gitdir: ../.git\n")
+
+      self.assertEqual(state, repo.GitRepo(worktree).ref_state())
+
+   def test_missing_git_dir(self):
+      self.assertEqual(None, repo.GitRepo(os.path.join(self.tmpdir, "none")).ref_state())
+
+class FsRepoTest(unittest.TestCase):
+
+   def setUp(self):
+      self.tmpdir = tempfile.mkdtemp()
+      os.makedirs(os.path.join(self.tmpdir, "dir"))
+      os.makedirs(os.path.join(self.tmpdir, ".squeeze"))
+      self.write("dir/file1", "one")
+      self.write("file2", "two")
+      self.write(".squeeze/config.yml", "repo: fs")
+      self.start = self.scan()
+
+   def tearDown(self):
+      shutil.rmtree(self.tmpdir)
+
+   def write(self, path, content):
+      with open(os.path.join(self.tmpdir, path), "w") as f:
+         f.write(content)
+
+   def scan(self):
+      return repo.FsRepo(self.tmpdir).commit_list[0]
+
+   def diff(self, a, b):
+      return repo.FsRepo(self.tmpdir).diff(a, b)
+
+   def test_initial_diff(self):
+      self.assertEqual([
+         (FILE_ADDED, ["dir/file1"]),
+         (FILE_ADDED, ["file2"])
+      ], self.diff(None, self.start))
+
+   def test_unchanged_directory_reuses_snapshot(self):
+      self.assertEqual(self.start, self.scan())
+
+   def test_detect_changes(self):
+      self.write("dir/file1", "changed")
+      self.write("file3", "three")
+      os.remove(os.path.join(self.tmpdir, "file2"))
+
+      self.assertEqual([
+         (FILE_MODIFIED, ["dir/file1"]),
+         (FILE_ADDED, ["file3"]),
+         (FILE_DELETED, ["file2"])
+      ], self.diff(self.start, self.scan()))
+
+   def test_detect_rename_by_inode(self):
+      os.rename(os.path.join(self.tmpdir, "file2"), os.path.join(self.tmpdir, "dir/file2"))
+
+      self.assertEqual([
+         (FILE_RENAMED, ["file2", "dir/file2"])
+      ], self.diff(self.start, self.scan()))
+
+   def test_detect_rename_by_hash(self):
+      self.write("file3", "three")
+      middle = self.scan()
+
+      os.remove(os.path.join(self.tmpdir, "file3"))
+      self.write("dir/file3", "three")
+
+      self.assertEqual([
+         (FILE_RENAMED, ["file3", "dir/file3"])
+      ], self.diff(middle, self.scan()))
+
+   def test_detect_rename_of_touched_file_by_inode(self):
+      self.write("file3", "three")
+      middle = self.scan()
+
+      os.rename(os.path.join(self.tmpdir, "file3"), os.path.join(self.tmpdir, "dir/file3"))
+      os.utime(os.path.join(self.tmpdir, "dir/file3"), (1, 1))
+
+      self.assertEqual([
+         (FILE_RENAMED, ["file3", "dir/file3"])
+      ], self.diff(middle, self.scan()))
+
+   def test_detect_rename_of_modified_file_by_inode(self):
+      os.rename(os.path.join(self.tmpdir, "file2"), os.path.join(self.tmpdir, "dir/file2"))
+      with open(os.path.join(self.tmpdir, "dir/file2"), "a") as f:
+         f.write(" more")
+
+      self.assertEqual([
+         (FILE_RENAMED, ["file2", "dir/file2"]),
+         (FILE_MODIFIED, ["dir/file2"])
+      ], self.diff(self.start, self.scan()))
+
+   def test_file_removed_during_scan_is_skipped(self):
+      self.write("file3", "three")
+      with mock.patch.object(repo.FsRepo, "_hash_path", side_effect=FileNotFoundError()):
+         tip = self.scan()
+
+      self.assertEqual([], self.diff(self.start, tip))
+
+   def test_unreadable_file_is_kept(self):
+      self.write("file3", "three")
+      with mock.patch.object(repo.FsRepo, "_hash_path", side_effect=PermissionError()):
+         tip = self.scan()
+
+      self.assertEqual([(FILE_ADDED, ["file3"])], self.diff(self.start, tip))
+
+   def test_unreadable_directory_keeps_previous_entries(self):
+      self.write("dir/file3", "three")
+      scandir = os.scandir
+
+      def fake_scandir(path):
+         if path.endswith("dir"):
+            raise PermissionError(path)
+         return scandir(path)
+
+      with mock.patch("os.scandir", side_effect=fake_scandir):
+         tip = self.scan()
+
+      self.assertEqual([], self.diff(self.start, tip))
+
+   def test_touched_file_is_not_modified(self):
+      self.write("file3", "three")
+      middle = self.scan()
+
+      os.utime(os.path.join(self.tmpdir, "file3"), (1, 1))
+
+      self.assertEqual([], self.diff(middle, self.scan()))
+
+   def test_prune_old_snapshots(self):
+      for i in range(3):
+         self.write("file2", "change {0}".format(i))
+         repo.FsRepo(self.tmpdir, keep_snapshots=2).commit_list
+
+      self.assertEqual(2, len(repo.FsRepo(self.tmpdir).commit_list))
+
+   def test_prune_keeps_cursor_snapshot(self):
+      self.write(".squeeze/latest", self.start)
+      for i in range(3):
+         self.write("file2", "change {0}".format(i))
+         repo.FsRepo(self.tmpdir, keep_snapshots=2).commit_list
+
+      commits = repo.FsRepo(self.tmpdir).commit_list
+      self.assertEqual(3, len(commits))
+      self.assertEqual(self.start, commits[-1])
+      self.assertEqual([(FILE_MODIFIED, ["file2"])], self.diff(self.start, commits[0]))
+
+   def test_read_only_scan_is_not_recorded(self):
+      self.write("file3", "three")
+      d = repo.FsRepo(self.tmpdir, read_only=True)
+      tip = d.commit_list[0]
+
+      self.assertEqual([(FILE_ADDED, ["file3"])], d.diff(self.start, tip))
+      self.assertEqual([self.start], repo.FsRepo(self.tmpdir, read_only=True)._read_history())
+      self.assertFalse(os.path.exists(os.path.join(self.tmpdir, ".squeeze", "fs", tip)))